@@ -0,0 +1,73 @@
+"""
+Streamlitの全セッションで共有するリソース（Geminiモデル、各種キャッシュ、検索インデックス、セッションストア）を作成するモジュールです。
+@st.cache_resource のキャッシュはプロセス単位で保持されるため、serve.py がサーバーの起動前にこれらを呼び出しておけば、
+最初のユーザーのリクエストでモデルの初期化などを待つ必要がなくなります。
+"""
+import os
+
+import streamlit as st
+
+from gemini_assistant import embed_texts, initialize_gemini_model
+from page_cache import PageCache
+from response_cache import ResponseCache
+from retrieval_index import RetrievalIndex
+from session_store import open_session_store
+
+# メモリに保持する検索インデックスの最大数と保持時間 (ゲーム名ごとに1つ作られるため上限を設ける。追い出した分は必要なときにディスクから読み直す)
+RETRIEVAL_INDEX_CACHE_MAX_ENTRIES = 32
+RETRIEVAL_INDEX_CACHE_TTL_SECONDS = 60 * 60
+
+
+# Geminiモデルの初期化 (パフォーマンスのためにキャッシュ)
+# @st.cache_resource デコレータは、関数が同じ引数で呼び出された場合、
+# その結果をキャッシュし、アプリの再実行時に再計算しないようにします。
+@st.cache_resource
+def get_gemini_model(_api_key, model_name=None):
+    """
+    Geminiモデルを初期化し、キャッシュします。
+    model_name ごとに別のインスタンスをキャッシュします（None の場合は GEMINI_MODEL_NAME のモデル）。
+    """
+    if not _api_key:
+        return None
+    try:
+        model = initialize_gemini_model(_api_key, model_name)
+        return model
+    except Exception as e:
+        # モデル初期化のエラーをStreamlit UIに表示
+        st.error(f"Geminiモデルの初期化中にエラーが発生しました。APIキーが正しいか、またはモデル名が利用可能か確認してください: {e}")
+        return None
+
+
+@st.cache_resource
+def get_page_cache():
+    """
+    参照URLの解析結果を保存するディスクキャッシュを、全セッションで共有します。
+    """
+    return PageCache()
+
+
+@st.cache_resource
+def get_response_cache():
+    """
+    回答キャッシュ（SQLite）を、全セッションで共有します。
+    """
+    return ResponseCache()
+
+
+@st.cache_resource
+def get_session_store():
+    """
+    会話のセッションを保存するストア（SQLite または Redis）を、全セッションで共有します。
+    """
+    return open_session_store()
+
+
+@st.cache_resource(max_entries=RETRIEVAL_INDEX_CACHE_MAX_ENTRIES, ttl=RETRIEVAL_INDEX_CACHE_TTL_SECONDS)
+def get_retrieval_index(game_name):
+    """
+    ゲームごとの検索インデックスを、全セッションで共有します。
+    メモリに保持するのは最近使われた RETRIEVAL_INDEX_CACHE_MAX_ENTRIES 件までで、RETRIEVAL_INDEX_CACHE_TTL_SECONDS 秒で破棄します。
+    環境変数 GEMINI_EMBEDDING_MODEL_NAME が設定されている場合は、埋め込みによる再順位付けも行います。
+    """
+    embed_fn = embed_texts if os.getenv("GEMINI_EMBEDDING_MODEL_NAME") else None
+    return RetrievalIndex(game_name, embed_fn=embed_fn)
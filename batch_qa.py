@@ -0,0 +1,235 @@
+"""
+よくある質問の回答を、ゲームごとにまとめて事前に生成するバッチ処理です。
+
+入力は (ゲーム名, 参照URL, 質問) の行を並べた JSON Lines または CSV ファイルです（id 列は任意）。
+同じゲーム・URLの行では、サイトの巡回と検索インデックス、ゲーム名とURLを含む指示文を共有し、
+各質問は共有クライアント（gemini_client.py）のレート制限の範囲内で並行して問い合わせます。
+
+結果は1行ごとに JSON Lines で出力ファイルに追記します。途中で止まった場合も、同じ出力ファイルを指定して
+再実行すれば、回答済みの行を飛ばして続きから処理します。--seed-cache を指定すると、出力した回答を
+回答キャッシュ（response_cache.py）に保存し、アプリで同じ質問をされたときにすぐ返せるようにします。
+
+    python batch_qa.py questions.csv -o answers.jsonl [--concurrency 4] [--seed-cache]
+
+入力の例 (CSV):
+    game_name,url,question
+    ゼルダの伝説 ティアーズ オブ ザ キングダム,https://example.com/zelda/,序盤でバッテリーを増やすには？
+"""
+import argparse
+import csv
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlparse
+
+from conversation_history import build_preamble, with_reference
+from gemini_assistant import ask_gemini, embed_texts, initialize_gemini_model
+from instrumentation import record, span, start_trace
+from page_cache import PageCache
+from response_cache import ResponseCache
+from retrieval_index import RetrievalIndex, format_reference_chunks, index_site
+
+DEFAULT_BATCH_CONCURRENCY = 4
+
+
+def row_id(game_name: str, url: str, question: str) -> str:
+    """
+    id 列がない行の識別子を、ゲーム名・URL・質問から決めます（再実行しても同じ値になる）。
+    """
+    return hashlib.sha256(f"{game_name}\n{url}\n{question}".encode("utf-8")).hexdigest()[:16]
+
+
+def read_rows(path: str) -> list[dict]:
+    """
+    入力ファイル（拡張子が .csv の場合はCSV、それ以外は JSON Lines）から質問の行を読み込みます。
+    """
+    with open(path, encoding="utf-8-sig", newline="") as f:
+        if path.lower().endswith(".csv"):
+            records = list(csv.DictReader(f))
+        else:
+            records = [json.loads(line) for line in f if line.strip()]
+
+    rows = []
+    for number, item in enumerate(records, 1):
+        game_name = (item.get("game_name") or item.get("game") or "").strip()
+        url = (item.get("url") or "").strip()
+        question = (item.get("question") or "").strip()
+        if not game_name or not question:
+            print(f"{path} の {number} 行目はゲーム名または質問がないため、スキップします。")
+            continue
+        rows.append({
+            "id": str(item.get("id") or row_id(game_name, url, question)),
+            "game_name": game_name,
+            "url": url,
+            "question": question,
+        })
+    return rows
+
+
+def read_completed_ids(output_path: str) -> set[str]:
+    """
+    出力ファイルにすでに書き込まれている（回答済みの）行の id を返します。
+    書き込み途中で止まった最後の行など、壊れた行は無視します。
+    """
+    completed = set()
+    if not os.path.exists(output_path):
+        return completed
+    with open(output_path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                completed.add(json.loads(line)["id"])
+            except (ValueError, KeyError):
+                continue
+    return completed
+
+
+class GameContext:
+    """
+    同じゲーム・参照URLの行で共有する、指示文と参照サイトの検索インデックスです。
+    """
+
+    def __init__(self, game_name: str, url: str, index: RetrievalIndex | None):
+        self.game_name = game_name
+        self.url = url
+        self.preamble = build_preamble(game_name, url)
+        self.index = index
+
+    def build_contents(self, question: str) -> list[dict]:
+        """
+        アプリでの最初の質問と同じ形式（指示文 + 参照サイトから検索した情報 + 質問）の会話履歴を作ります。
+        """
+        contents = [{"role": "user", "parts": [self.preamble + question]}]
+        if self.index is None:
+            return contents
+        parsed_url = urlparse(self.url)
+        chunks = self.index.search(question, top_k=4, url_prefix=f"{parsed_url.scheme}://{parsed_url.netloc}")
+        return with_reference(contents, format_reference_chunks(chunks))
+
+
+def prepare_contexts(rows: list[dict], page_cache: PageCache) -> dict[tuple[str, str], GameContext]:
+    """
+    ゲーム・URLの組み合わせごとに一度だけサイトを巡回し、共有する GameContext を作ります。
+    """
+    indexes: dict[str, RetrievalIndex] = {}
+    embed_fn = embed_texts if os.getenv("GEMINI_EMBEDDING_MODEL_NAME") else None
+    contexts = {}
+    for game_name, url in dict.fromkeys((row["game_name"], row["url"]) for row in rows):
+        index = None
+        if url:
+            if game_name not in indexes:
+                indexes[game_name] = RetrievalIndex(game_name, embed_fn=embed_fn)
+            index = indexes[game_name]
+            print(f"{game_name}: {url} を巡回しています...")
+            index_site(index, url, page_cache=page_cache)
+        contexts[(game_name, url)] = GameContext(game_name, url, index)
+    return contexts
+
+
+def answer_row(model, context: GameContext, row: dict) -> dict | None:
+    """
+    1行分の質問に回答し、出力する結果を返します。回答を取得できなかった場合は None を返します。
+    """
+    with start_trace("batch_answer", game_name=row["game_name"]) as trace:
+        with span("retrieval"):
+            contents = context.build_contents(row["question"])
+        answer = ask_gemini(model, contents)
+        record("answered", answer is not None)
+    if not answer:
+        return None
+    return {
+        **row,
+        "answer": answer,
+        "model": model.model_name,
+        "elapsed_ms": trace.duration_ms,
+        "answered_at": time.time(),
+    }
+
+
+def run_batch(model, rows: list[dict], output_path: str, concurrency: int = DEFAULT_BATCH_CONCURRENCY, page_cache: PageCache | None = None) -> tuple[int, int]:
+    """
+    回答済みでない行を並行して処理し、結果を出力ファイルに1行ずつ追記します。
+    (回答できた行数, 失敗した行数) を返します。失敗した行は出力しないため、再実行時にもう一度処理されます。
+    """
+    completed = read_completed_ids(output_path)
+    pending = [row for row in rows if row["id"] not in completed]
+    print(f"{len(rows)} 件中 {len(rows) - len(pending)} 件は回答済みのため、{len(pending)} 件を処理します。")
+    if not pending:
+        return 0, 0
+
+    contexts = prepare_contexts(pending, page_cache or PageCache())
+    if os.path.dirname(output_path):
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    write_lock = threading.Lock()
+    answered = failed = 0
+
+    with open(output_path, "a", encoding="utf-8") as output, ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {
+            executor.submit(answer_row, model, contexts[(row["game_name"], row["url"])], row): row
+            for row in pending
+        }
+        for future in as_completed(futures):
+            row = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                print(f"[{row['id']}] 処理中にエラーが発生しました: {e}")
+                result = None
+            if result is None:
+                failed += 1
+                continue
+            with write_lock:
+                # 1行ごとに書き出し、途中で止まっても回答済みの行を失わないようにする
+                output.write(json.dumps(result, ensure_ascii=False) + "\n")
+                output.flush()
+            answered += 1
+            print(f"[{answered + failed}/{len(pending)}] {row['game_name']}: {row['question']}")
+    return answered, failed
+
+
+def seed_response_cache(output_path: str, cache: ResponseCache) -> int:
+    """
+    出力ファイルの回答を回答キャッシュに保存し、保存した件数を返します。
+    アプリの最初の質問と同じキー（モデル名, ゲーム名, 参照URL, 質問）で保存します。
+    """
+    count = 0
+    with open(output_path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+                cache.put(result["model"], result["game_name"], result["url"], result["question"], result["answer"])
+            except (ValueError, KeyError):
+                continue
+            count += 1
+    return count
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="ゲームごとのよくある質問の回答をまとめて生成します")
+    parser.add_argument("input", help="質問の一覧 (JSON Lines または CSV。game_name, url, question 列、id 列は任意)")
+    parser.add_argument("-o", "--output", default="answers.jsonl", help="回答を追記する JSON Lines ファイル")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_BATCH_CONCURRENCY, help="同時に問い合わせる質問の数")
+    parser.add_argument("--seed-cache", action="store_true", help="出力した回答を回答キャッシュに保存する")
+    args = parser.parse_args()
+
+    api_key = os.getenv("GEMINI_API_KEY")
+    if not api_key:
+        print("エラー: GEMINI_API_KEY環境変数が設定されていません。")
+        return 1
+    model = initialize_gemini_model(api_key)
+    if model is None:
+        return 1
+
+    answered, failed = run_batch(model, read_rows(args.input), args.output, concurrency=args.concurrency)
+    print(f"回答: {answered} 件, 失敗: {failed} 件 (失敗した質問は再実行時にもう一度処理されます)")
+
+    if args.seed_cache and os.path.exists(args.output):
+        print(f"{seed_response_cache(args.output, ResponseCache())} 件の回答を回答キャッシュに保存しました。")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
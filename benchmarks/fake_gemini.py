@@ -0,0 +1,80 @@
+"""
+ベンチマーク用の、ネットワークに接続しない GenerativeModel の代替です。
+応答までの待ち時間と、ストリーミング時のチャンクの間隔を設定できます。
+"""
+import asyncio
+import time
+from types import SimpleNamespace
+
+
+class FakeResponse:
+    """
+    GenerateContentResponse と同じく text と usage_metadata を持つ応答です。
+    """
+
+    def __init__(self, text: str, prompt_tokens: int):
+        self.text = text
+        self.usage_metadata = SimpleNamespace(prompt_token_count=prompt_tokens, candidates_token_count=len(text))
+
+
+class FakeAsyncStream:
+    """
+    AsyncGenerateContentResponse の代わりに、最初のチャンクはすぐに、以降は一定間隔でチャンクを返す非同期イテレーターです。
+    """
+
+    def __init__(self, chunks: list[str], interval: float, prompt_tokens: int):
+        self.chunks = chunks
+        self.interval = interval
+        self.prompt_tokens = prompt_tokens
+
+    async def __aiter__(self):
+        for i, chunk in enumerate(self.chunks):
+            if i:
+                await asyncio.sleep(self.interval)
+            yield FakeResponse(chunk, self.prompt_tokens)
+
+
+class FakeGenerativeModel:
+    """
+    genai.GenerativeModel の代わりに使うモデルです。
+
+    - latency: 非ストリーミングの応答、およびストリーミングの最初のチャンクまでの待ち時間（秒）
+    - chunk_interval: ストリーミングで2つ目以降のチャンクを返す間隔（秒）
+    - response_text / chunk_count: 応答の本文と、ストリーミング時に分割するチャンク数
+    """
+
+    def __init__(
+        self,
+        model_name: str = "models/fake-gemini",
+        latency: float = 0.05,
+        chunk_interval: float = 0.01,
+        response_text: str = "序盤は祠を巡ってゾナウギアを集め、バッテリーを強化しましょう。" * 10,
+        chunk_count: int = 20,
+    ):
+        self.model_name = model_name
+        self.latency = latency
+        self.chunk_interval = chunk_interval
+        self.response_text = response_text
+        self.chunk_count = chunk_count
+        self.calls = 0
+
+    @staticmethod
+    def _prompt_tokens(contents) -> int:
+        return sum(len(part) for content in contents for part in content["parts"])
+
+    def _chunks(self) -> list[str]:
+        size = max(len(self.response_text) // self.chunk_count, 1)
+        return [self.response_text[i:i + size] for i in range(0, len(self.response_text), size)]
+
+    def generate_content(self, contents, stream: bool = False, **kwargs):
+        self.calls += 1
+        time.sleep(self.latency)
+        return FakeResponse(self.response_text, self._prompt_tokens(contents))
+
+    async def generate_content_async(self, contents, stream: bool = False, **kwargs):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        if stream:
+            # 最初のチャンクは latency 後、以降は chunk_interval ごとに返す
+            return FakeAsyncStream(self._chunks(), self.chunk_interval, self._prompt_tokens(contents))
+        return FakeResponse(self.response_text, self._prompt_tokens(contents))
@@ -0,0 +1,82 @@
+"""
+ベンチマーク用の攻略ページのHTMLを生成し、benchmarks/fixtures/ に保存します。
+ページの大きさと入れ子の深さが異なる数種類のページを、乱数のシードを固定して毎回同じ内容で生成します。
+
+    python -m benchmarks.make_fixtures
+"""
+import os
+import random
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), "fixtures")
+
+WORDS = [
+    "祠", "バッテリー", "ゾナウギア", "ウルトラハンド", "スクラビルド", "ボコブリン", "ライネル", "回生の祠",
+    "がんばりゲージ", "ハートの器", "素材", "料理", "装備", "攻略", "入手方法", "おすすめ", "序盤", "ボス",
+]
+
+
+def _sentence(rng: random.Random) -> str:
+    return "".join(rng.choice(WORDS) + rng.choice(["を", "は", "の", "で", "に"]) for _ in range(rng.randint(4, 10))) + "集めましょう。"
+
+
+def _boilerplate(rng: random.Random) -> str:
+    nav_links = "".join(f'<li><a href="/guide/{i}.html">攻略{i}</a></li>' for i in range(30))
+    return (
+        f'<header class="header"><nav class="menu"><ul>{nav_links}</ul></nav></header>'
+        f'<aside class="sidebar"><div class="ad">{_sentence(rng)}</div><div class="widget">{_sentence(rng)}</div></aside>'
+    )
+
+
+def wiki_page(sections: int, paragraphs: int, seed: int) -> str:
+    """
+    見出しと段落が並ぶ、一般的な攻略Wiki風のページを生成します。
+    """
+    rng = random.Random(seed)
+    body = []
+    for s in range(sections):
+        body.append(f'<div class="section"><h2 id="s{s}">{rng.choice(WORDS)}の{rng.choice(WORDS)}</h2>')
+        for _ in range(paragraphs):
+            body.append(f'<div class="content"><p>{_sentence(rng)}<span>{_sentence(rng)}</span></p></div>')
+        body.append(
+            "<table>" + "".join(f"<tr><td>{rng.choice(WORDS)}</td><td>{rng.randint(1, 999)}</td></tr>" for _ in range(5)) + "</table>"
+        )
+        body.append(f'<p><a href="/guide/{s}.html#detail">{rng.choice(WORDS)}の詳細</a></p></div>')
+    return (
+        "<!DOCTYPE html><html><head><title>攻略Wiki ベンチマーク</title>"
+        "<script>var tracking = 1;</script><style>.ad{display:none}</style></head><body>"
+        f'{_boilerplate(rng)}<main><article>{"".join(body)}</article></main>'
+        f'<footer class="footer">{_sentence(rng)}</footer></body></html>'
+    )
+
+
+def deep_page(depth: int, seed: int) -> str:
+    """
+    div が深く入れ子になったページを生成します（入れ子の深さに比例して処理量が増える実装の検出用）。
+    """
+    rng = random.Random(seed)
+    opening = "".join(f'<div class="level"><p>{_sentence(rng)}</p>' for _ in range(depth))
+    return (
+        "<!DOCTYPE html><html><head><title>深い入れ子 ベンチマーク</title></head><body>"
+        f"{_boilerplate(rng)}<main>{opening}{'</div>' * depth}</main></body></html>"
+    )
+
+
+FIXTURES = {
+    "small.html": lambda: wiki_page(sections=3, paragraphs=3, seed=1),
+    "medium.html": lambda: wiki_page(sections=20, paragraphs=10, seed=2),
+    "large.html": lambda: wiki_page(sections=80, paragraphs=20, seed=3),
+    "deep.html": lambda: deep_page(depth=300, seed=4),
+}
+
+
+def main() -> None:
+    os.makedirs(FIXTURES_DIR, exist_ok=True)
+    for name, build in FIXTURES.items():
+        path = os.path.join(FIXTURES_DIR, name)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(build())
+        print(f"{path}: {os.path.getsize(path) // 1024} KB")
+
+
+if __name__ == "__main__":
+    main()
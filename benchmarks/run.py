@@ -0,0 +1,193 @@
+"""
+ネットワークに接続せずに実行できるベンチマークです。
+
+- parse_html_stream: benchmarks/fixtures/ の大きさや入れ子の深さが異なるページを、
+  ページの取得時 (fetch_and_parse_stream) と同じく 64KB ずつ受け取りながら解析 (iter_html_events)
+- history: 長いセッションでの1ターンあたりの会話履歴の組み立て (ConversationHistory + ContextWindow)
+- ask_gemini / ask_gemini_stream: FakeGenerativeModel を使った、共有クライアント経由の問い合わせ全体
+
+それぞれのスループットと p50 / p95 / p99 のレイテンシを表示します。
+--save-baseline で結果を benchmarks/baseline.json に保存し、以降の実行ではベースラインと比較して
+p50 がしきい値の割合を超えて、かつ --min-delta-ms 以上遅くなった項目があれば終了コード 1 を返します。
+（数ミリ秒の項目が揺らぎだけで失敗しないよう、割合と差の両方で判定します。
+ベースラインは計測したマシンに依存するため、同じ環境で1回の --save-baseline でまとめて取り直してください）
+
+    python -m benchmarks.run [--iterations N] [--save-baseline] [--threshold 0.2] [--min-delta-ms 2.0]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# ベンチマークではレート制限で待たされないよう、上限を十分に大きくしてから共有クライアントを読み込む
+os.environ.setdefault("GEMINI_REQUESTS_PER_MINUTE", "1000000")
+os.environ.setdefault("GEMINI_MAX_CONCURRENCY", "64")
+
+from benchmarks.fake_gemini import FakeGenerativeModel
+from context_window import ContextWindow
+from conversation_history import ConversationHistory
+from gemini_assistant import ask_gemini, ask_gemini_stream
+from web_scraper import STREAM_CHUNK_BYTES, collect_html_events, iter_html_events
+
+BENCHMARKS_DIR = os.path.dirname(__file__)
+FIXTURES_DIR = os.path.join(BENCHMARKS_DIR, "fixtures")
+BASELINE_PATH = os.path.join(BENCHMARKS_DIR, "baseline.json")
+
+
+def percentile(sorted_samples: list[float], q: float) -> float:
+    """
+    最近順位法でパーセンタイルを求めます（sorted_samples は昇順にソート済み）。
+    """
+    index = max(0, min(len(sorted_samples) - 1, round(q / 100 * len(sorted_samples) + 0.5) - 1))
+    return sorted_samples[index]
+
+
+def summarize(samples: list[float], elapsed: float | None = None) -> dict:
+    """
+    計測値（秒）のリストから、スループットとレイテンシのパーセンタイル（ミリ秒）を求めます。
+    elapsed を渡した場合は、並列実行時の全体の所要時間からスループットを計算します。
+    """
+    ordered = sorted(samples)
+    total = elapsed if elapsed is not None else sum(samples)
+    return {
+        "iterations": len(samples),
+        "throughput_per_s": round(len(samples) / total, 2) if total else 0.0,
+        "p50_ms": round(percentile(ordered, 50) * 1000, 3),
+        "p95_ms": round(percentile(ordered, 95) * 1000, 3),
+        "p99_ms": round(percentile(ordered, 99) * 1000, 3),
+    }
+
+
+def measure(func, iterations: int, warmup: int = 3) -> list[float]:
+    for _ in range(warmup):
+        func()
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def bench_parse(iterations: int) -> dict:
+    results = {}
+    for name in sorted(os.listdir(FIXTURES_DIR)):
+        if not name.endswith(".html"):
+            continue
+        with open(os.path.join(FIXTURES_DIR, name), encoding="utf-8") as f:
+            html = f.read()
+        chunks = [html[i:i + STREAM_CHUNK_BYTES] for i in range(0, len(html), STREAM_CHUNK_BYTES)]
+        results[f"parse_html_stream[{name}]"] = summarize(
+            measure(lambda: collect_html_events(iter_html_events(chunks, "https://example.com/guide/")), iterations)
+        )
+    return results
+
+
+def bench_history(turns: int) -> dict:
+    """
+    turns ターンのセッションで、質問を追加してから送信用の履歴を組み立てるまでの1ターンあたりの時間を計測します。
+    要約は固定の文字列を返す関数で代用し、トークン予算を小さくして要約への折り込みも発生させます。
+    """
+    history = ConversationHistory("ゼルダの伝説 ティアーズ オブ ザ キングダム", "https://example.com/guide/")
+    window = ContextWindow(lambda previous, folded: "これまでの会話の要約。" * 20, token_budget=8000)
+    history.append("assistant", "攻略アシスタントを開始します。")
+    samples = []
+    for turn in range(turns):
+        start = time.perf_counter()
+        history.append("user", f"{turn}回目の質問: 序盤でバッテリーを効率的に増やすにはどうすれば良いですか？")
+        window.build(history)
+        samples.append(time.perf_counter() - start)
+        history.append("assistant", "祠を巡ってゾナウギアを集め、バッテリーを強化しましょう。" * 10)
+    return {f"history_build[{turns} turns]": summarize(samples)}
+
+
+def bench_ask_gemini(iterations: int, concurrency: int) -> dict:
+    model = FakeGenerativeModel(latency=0.02, chunk_interval=0.002)
+    counter = iter(range(10 ** 9))
+
+    def contents():
+        # 同一内容のリクエストは合流されるため、毎回異なる質問にする
+        return [{"role": "user", "parts": [f"質問{next(counter)}: バッテリーを増やすには？"]}]
+
+    def ask_once():
+        start = time.perf_counter()
+        ask_gemini(model, contents())
+        return time.perf_counter() - start
+
+    results = {"ask_gemini[sequential]": summarize(measure(lambda: ask_gemini(model, contents()), iterations))}
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        samples = list(executor.map(lambda _: ask_once(), range(iterations)))
+    results[f"ask_gemini[{concurrency} concurrent]"] = summarize(samples, elapsed=time.perf_counter() - start)
+
+    first_token_samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        stream = ask_gemini_stream(model, contents())
+        next(stream)
+        first_token_samples.append(time.perf_counter() - start)
+        for _ in stream:
+            pass
+    results["ask_gemini_stream[time_to_first_token]"] = summarize(first_token_samples)
+    return results
+
+
+def compare(results: dict, baseline: dict, threshold: float, min_delta_ms: float) -> list[str]:
+    """
+    ベースラインより p50 が threshold の割合を超え、かつ min_delta_ms ミリ秒以上遅くなった項目を返します。
+    p95 以上は少ない計測回数では外れ値に左右されやすいため、判定には使わず表示のみとします。
+    """
+    regressions = []
+    for name, summary in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        slower = summary["p50_ms"] - base["p50_ms"]
+        if summary["p50_ms"] > base["p50_ms"] * (1 + threshold) and slower >= min_delta_ms:
+            regressions.append(f"{name} p50_ms: {base['p50_ms']} -> {summary['p50_ms']} ms")
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="ゲーム攻略アシスタントのオフラインベンチマーク")
+    parser.add_argument("--iterations", type=int, default=50, help="各ベンチマークの計測回数")
+    parser.add_argument("--turns", type=int, default=300, help="会話履歴のベンチマークのターン数")
+    parser.add_argument("--concurrency", type=int, default=8, help="ask_gemini の並列実行数")
+    parser.add_argument("--save-baseline", action="store_true", help="結果をベースラインとして保存する")
+    parser.add_argument("--threshold", type=float, default=0.2, help="遅くなったと判定する割合 (0.2 = 20%%)")
+    parser.add_argument("--min-delta-ms", type=float, default=2.0, help="遅くなったと判定する最小の差 (ミリ秒)")
+    args = parser.parse_args()
+
+    results = {}
+    results.update(bench_parse(args.iterations))
+    results.update(bench_history(args.turns))
+    results.update(bench_ask_gemini(args.iterations, args.concurrency))
+
+    print(f"{'benchmark':<48} {'ops/s':>10} {'p50 ms':>10} {'p95 ms':>10} {'p99 ms':>10}")
+    for name, summary in results.items():
+        print(f"{name:<48} {summary['throughput_per_s']:>10} {summary['p50_ms']:>10} {summary['p95_ms']:>10} {summary['p99_ms']:>10}")
+
+    if args.save_baseline:
+        with open(BASELINE_PATH, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"\nベースラインを保存しました: {BASELINE_PATH}")
+        return 0
+
+    if not os.path.exists(BASELINE_PATH):
+        return 0
+    with open(BASELINE_PATH, encoding="utf-8") as f:
+        regressions = compare(results, json.load(f), args.threshold, args.min_delta_ms)
+    if regressions:
+        print("\nベースラインより遅くなった項目:")
+        for line in regressions:
+            print(f"  - {line}")
+        return 1
+    print("\nベースラインとの比較: 問題なし")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
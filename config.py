@@ -0,0 +1,17 @@
+"""
+環境変数から設定値を読み込むための共通の関数をまとめたモジュールです。
+"""
+import os
+
+
+def env_number(name: str, default, cast=int):
+    """
+    環境変数 name の値を cast（int や float）で変換して返します。
+    未設定の場合はデフォルト値を使い、不正な値の場合はメッセージを出力してデフォルト値を使います。
+    """
+    value = os.getenv(name)
+    try:
+        return cast(value) if value else default
+    except ValueError:
+        print(f"{name} の値 '{value}' が不正なため、デフォルト値 {default} を使用します。")
+        return default
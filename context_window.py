@@ -0,0 +1,154 @@
+"""
+Gemini APIに渡す会話履歴を、トークン予算内に収めるためのモジュールです。
+直近のやり取りはそのまま残し、それより古いやり取りは要約にまとめて最初のプロンプトに付加します。
+要約は予算を超えたときにだけ更新されるため、通常のターンでは追加のAPI呼び出しは発生しません。
+"""
+from collections.abc import Callable
+
+from config import env_number
+from gemini_assistant import ask_gemini
+
+# 環境変数 GEMINI_CONTEXT_TOKEN_BUDGET が設定されていない場合のトークン予算
+DEFAULT_CONTEXT_TOKEN_BUDGET = 32000
+
+# 要約の最大文字数（要約自体が予算を圧迫しないようにするため）
+SUMMARY_MAX_CHARS = 800
+
+
+def get_context_token_budget() -> int:
+    """
+    環境変数 GEMINI_CONTEXT_TOKEN_BUDGET からトークン予算を読み込みます。
+    未設定または不正な値の場合はデフォルト値を使用します。
+    """
+    return max(env_number("GEMINI_CONTEXT_TOKEN_BUDGET", DEFAULT_CONTEXT_TOKEN_BUDGET), 1000)
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    テキストのトークン数を概算します。
+    APIの count_tokens は1回ごとにネットワーク通信が発生するため、ここでは文字種から見積もります。
+    （英数字はおよそ4文字で1トークン、日本語などの非ASCII文字はおよそ1文字で1トークン）
+    """
+    ascii_count = len(text.encode("ascii", "ignore"))
+    return ascii_count // 4 + (len(text) - ascii_count) + 1
+
+
+def _content_text(content: dict) -> str:
+    return "".join(part for part in content["parts"] if isinstance(part, str))
+
+
+def make_gemini_summarizer(model) -> Callable[[str, list[dict]], str | None]:
+    """
+    Geminiモデルを使って、これまでの要約と古いやり取りを1つの要約にまとめる関数を返します。
+    """
+    def summarize(previous_summary: str, folded_contents: list[dict]) -> str | None:
+        transcript = "\n".join(
+            f"{'ユーザー' if content['role'] == 'user' else 'アシスタント'}: {_content_text(content)}"
+            for content in folded_contents
+        )
+        prompt = (
+            "以下はゲーム攻略アシスタントとユーザーの会話の一部です。"
+            "これまでの要約と新しいやり取りを統合し、今後の回答に必要な情報"
+            "（ゲームの進行状況、装備やアイテム、ユーザーの目標や好み、すでに回答した内容など）を残して、"
+            f"日本語で{SUMMARY_MAX_CHARS}文字以内に要約してください。\n\n"
+            f"【これまでの要約】\n{previous_summary or 'なし'}\n\n"
+            f"【新しいやり取り】\n{transcript}"
+        )
+        summary = ask_gemini(model, [{"role": "user", "parts": [prompt]}])
+        return summary[:SUMMARY_MAX_CHARS] if summary else None
+
+    return summarize
+
+
+class ContextWindow:
+    """
+    ConversationHistory の contents から、トークン予算内に収まる会話履歴を組み立てます。
+
+    - contents[0]（ゲーム名やURLの指示文を含む最初の質問）は常に残します。
+    - contents[1:summarized_upto] は要約済みとして、要約テキストに置き換えます。
+    - contents[summarized_upto:] は直近のやり取りとしてそのまま渡します。
+
+    全体が予算を超えたときだけ、直近のやり取りが予算の recent_ratio 以内に収まるまで古いものを要約に折り込みます。
+    各メッセージのトークン数はキャッシュされ、新しく追加された分だけが計算されます。
+    要約済みのやり取りは参照しないため、履歴からメモリを追い出してもかまいません（ConversationHistory.page_out）。
+    保存済みのセッションを再開する場合は、summary と summarized_upto を渡して作成します。
+    """
+
+    def __init__(
+        self,
+        summarize: Callable[[str, list[dict]], str | None],
+        token_budget: int | None = None,
+        recent_ratio: float = 0.5,
+        summary: str = "",
+        summarized_upto: int = 1,
+    ):
+        self.summarize = summarize
+        self.token_budget = token_budget or get_context_token_budget()
+        self.recent_ratio = recent_ratio
+        self.summary = summary
+        self.summarized_upto = summarized_upto
+        self._pinned_tokens = 0
+        self._token_counts: list[int] = [] # contents[summarized_upto:] の各メッセージのトークン数
+        self._recent_tokens = 0
+
+    def _update_token_counts(self, history) -> None:
+        if not self._pinned_tokens:
+            self._pinned_tokens = estimate_tokens(_content_text(history.first_content))
+        for content in history.contents_since(self.summarized_upto + len(self._token_counts)):
+            tokens = estimate_tokens(_content_text(content))
+            self._token_counts.append(tokens)
+            self._recent_tokens += tokens
+
+    def _total_tokens(self) -> int:
+        return self._pinned_tokens + estimate_tokens(self.summary) + self._recent_tokens
+
+    def _fold(self, recent: list[dict]) -> None:
+        """
+        直近のやり取りが予算の recent_ratio 以内に収まる位置を探し、それより古いやり取りを要約に折り込みます。
+        """
+        if len(recent) < 2:
+            return
+        keep_budget = int(self.token_budget * self.recent_ratio)
+        # 最新のメッセージ（今回の質問）と、その直前のモデルの回答は予算を超えても必ず残す
+        # (今回の質問が指している可能性が高く、要約を付加した最初の質問（userロール）の直後に来るのはmodelロールでなければならないため)
+        cut = len(recent) - 1
+        while cut > 0 and recent[cut]["role"] != "model":
+            cut -= 1
+        if cut <= 0:
+            return
+        kept_tokens = sum(self._token_counts[cut:])
+        while cut - 1 > 0 and kept_tokens + self._token_counts[cut - 1] <= keep_budget:
+            cut -= 1
+            kept_tokens += self._token_counts[cut]
+        # 予算内で残す範囲を広げた場合も、直近のやり取りはmodelロールから始める
+        while recent[cut]["role"] != "model":
+            cut += 1
+
+        summary = self.summarize(self.summary, recent[:cut])
+        if summary is None:
+            print("会話履歴の要約に失敗しました。今回は履歴を要約せずに送信します。")
+            return
+
+        self.summary = summary
+        self._recent_tokens -= sum(self._token_counts[:cut])
+        del self._token_counts[:cut]
+        self.summarized_upto += cut
+
+    def build(self, history) -> list[dict]:
+        """
+        トークン予算内に収まるよう調整した、Gemini API用の会話履歴を返します。
+        """
+        if history.first_content is None:
+            return []
+        self._update_token_counts(history)
+        if self._total_tokens() > self.token_budget:
+            self._fold(history.contents_since(self.summarized_upto))
+
+        recent = history.contents_since(self.summarized_upto)
+        if not self.summary:
+            return [history.first_content] + recent
+        first_prompt = (
+            f"{_content_text(history.first_content)}\n\n"
+            f"---\n**これまでの会話の要約:**\n{self.summary}"
+        )
+        return [{"role": "user", "parts": [first_prompt]}] + recent
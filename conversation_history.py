@@ -0,0 +1,168 @@
+"""
+Streamlitの会話履歴と、Gemini APIに渡す会話履歴（contents）を同期して保持するモジュールです。
+メッセージが追加されるたびに差分だけを変換するため、再実行のたびに全履歴を作り直す必要がありません。
+"""
+
+# Streamlitのロール名をGemini APIのロール名に対応付ける
+# Gemini APIは "user" と "model" のみを受け付けるため、"assistant" は "model" に変換します。
+GEMINI_ROLES = {"user": "user", "assistant": "model"}
+
+
+def build_preamble(game_name: str, url: str) -> str:
+    """
+    最初のユーザーの質問の前に付加する指示文（ゲーム名とURL情報を含む）を構築します。
+    """
+    if url:
+        # URLがある場合はURL参照を優先する指示をプロンプトに含めます。
+        instruction = (
+            f"あなたはゲーム攻略アシスタントです。ユーザーの質問に対し、**提供されたURL（{url}）の情報を最優先に参照し、"
+            "そのURLから回答が得られない場合や、より補足情報が必要な場合のみWeb検索（Grounding機能）を活用して**、"
+            "最も適切で役立つ攻略情報を提供してください。"
+        )
+    else:
+        # URLがない場合はWeb検索のみの指示をプロンプトに含めます。
+        instruction = (
+            "あなたはゲーム攻略アシスタントです。ユーザーの質問に対し、**Web検索（Grounding機能）を活用して**、"
+            "最も適切で役立つ攻略情報を提供してください。"
+        )
+
+    return (
+        f"{instruction}\n"
+        "回答は日本のゲームプレイヤー向けに、分かりやすく、整理された自然な日本語で提供してください。\n"
+        "\n"
+        "---\n"
+        f"**ゲーム名:** {game_name}\n"
+        "---\n"
+        "ユーザーからの質問: "
+    )
+
+
+class ConversationHistory:
+    """
+    UI表示用のメッセージ（messages）と、Gemini API形式の会話履歴（contents）を同時に保持します。
+
+    - messages: `{"role": "user" | "assistant", "content": str}` のリスト
+    - contents: `{"role": "user" | "model", "parts": [str]}` のリスト（ask_gemini にそのまま渡せる）
+
+    最初のユーザーの質問にのみ、ゲーム名とURL情報を含む指示文を付加します。
+    指示文はセッション開始時に一度だけ構築されます。
+
+    長いセッションでメモリを使い続けないよう、古いメッセージは page_out でメモリから追い出せます。
+    messages / contents は会話全体のうち messages_offset / contents_offset 番目以降だけを保持し、
+    最初の質問（first_content）は常に保持します。追い出した分はセッションストア（session_store.py）から読み直します。
+    """
+
+    def __init__(self, game_name: str = "", url: str = ""):
+        self.game_name = game_name
+        self.url = url
+        self.messages: list[dict] = []
+        self.contents: list[dict] = []
+        self.messages_offset = 0 # メモリから追い出したメッセージの数
+        self.contents_offset = 0 # メモリから追い出したcontentsの数
+        self.first_user_index: int | None = None # 会話全体での最初のユーザーの質問の位置
+        self.first_content: dict | None = None # 指示文を付加した最初の質問
+        self._preamble = build_preamble(game_name, url) if game_name else ""
+
+    @property
+    def message_count(self) -> int:
+        return self.messages_offset + len(self.messages)
+
+    @property
+    def content_count(self) -> int:
+        return self.contents_offset + len(self.contents)
+
+    def append(self, role: str, content: str) -> None:
+        """
+        メッセージを1件追加し、Gemini形式の contents にも差分だけを反映します。
+        """
+        self.messages.append({"role": role, "content": content})
+
+        if self.first_content is None:
+            if role == "assistant":
+                # 最初のユーザーの質問より前のアシスタントメッセージ（ウェルカムメッセージ）はUI表示専用のため、Geminiには渡しません。
+                return
+            self.first_user_index = self.message_count - 1
+            self.first_content = {"role": GEMINI_ROLES[role], "parts": [self._preamble + content]}
+            self.contents.append(self.first_content)
+            return
+
+        self.contents.append({"role": GEMINI_ROLES[role], "parts": [content]})
+
+    def contents_since(self, start: int) -> list[dict]:
+        """
+        会話全体で start 番目以降の contents を返します（start はメモリに残っている範囲であること）。
+        """
+        if start < self.contents_offset:
+            raise ValueError(f"contents[{start}:] はすでにメモリから追い出されています (offset={self.contents_offset})")
+        return self.contents[start - self.contents_offset:]
+
+    def page_out(self, max_messages: int, keep_contents_from: int) -> None:
+        """
+        UI表示用には直近 max_messages 件、Gemini用には会話全体で keep_contents_from 番目以降だけを残し、
+        それより古いメッセージをメモリから追い出します。
+        """
+        drop = len(self.messages) - max_messages
+        if drop > 0:
+            del self.messages[:drop]
+            self.messages_offset += drop
+        drop = min(keep_contents_from, self.content_count) - self.contents_offset
+        if drop > 0:
+            del self.contents[:drop]
+            self.contents_offset += drop
+
+    def prepend_messages(self, older: list[dict]) -> None:
+        """
+        追い出した古いメッセージを、UI表示用に読み直して先頭に戻します（contents には影響しません）。
+        """
+        older = older[-self.messages_offset:] if self.messages_offset else []
+        self.messages[:0] = older
+        self.messages_offset -= len(older)
+
+    @classmethod
+    def restore(
+        cls,
+        game_name: str,
+        url: str,
+        messages: list[dict],
+        messages_offset: int,
+        first_user_index: int | None,
+        first_user_message: str = "",
+    ) -> "ConversationHistory":
+        """
+        保存済みの会話のうち、messages_offset 番目以降のメッセージから会話履歴を復元します。
+        最初の質問が messages に含まれない場合は、その本文を first_user_message に渡します。
+        """
+        history = cls(game_name, url)
+        history.messages = list(messages)
+        history.messages_offset = messages_offset
+        if first_user_index is None:
+            return history
+
+        if first_user_index >= messages_offset:
+            first_user_message = messages[first_user_index - messages_offset]["content"]
+        history.first_user_index = first_user_index
+        history.first_content = {"role": GEMINI_ROLES["user"], "parts": [history._preamble + first_user_message]}
+        start = max(first_user_index, messages_offset)
+        history.contents_offset = start - first_user_index
+        history.contents = [
+            history.first_content if index == first_user_index
+            else {"role": GEMINI_ROLES[message["role"]], "parts": [message["content"]]}
+            for index, message in enumerate(messages[start - messages_offset:], start)
+        ]
+        return history
+
+
+def with_reference(contents: list[dict], reference: str) -> list[dict]:
+    """
+    最後のユーザーの質問の前に、参照ページから検索した情報を付加した会話履歴を返します。
+    参照情報はその回の問い合わせにだけ使うため、元の contents は変更しません。
+    """
+    if not reference or not contents or contents[-1]["role"] != "user":
+        return contents
+    question = "".join(contents[-1]["parts"])
+    prompt = (
+        "以下は参照URLのサイトから、この質問に関連する部分を抜き出したものです。回答の根拠として優先的に使用してください。\n"
+        f"---\n{reference}\n---\n"
+        f"{question}"
+    )
+    return contents[:-1] + [{"role": "user", "parts": [prompt]}]
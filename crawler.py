@@ -0,0 +1,159 @@
+"""
+攻略サイトを、参照URLから同一ドメイン内のリンクをたどって巡回するクローラーです。
+Keep-Alive接続をプールした共有セッションで複数ページを並行して取得し、
+解析が終わったページから順に返します。robots.txt の指示に従います。
+"""
+import contextvars
+import threading
+from collections.abc import Iterator
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from urllib.parse import urldefrag, urljoin, urlparse
+from urllib.robotparser import RobotFileParser
+
+import requests
+
+from web_scraper import DEFAULT_HEADERS, fetch_and_parse_stream, get_session
+
+# HTMLではないため巡回しないファイルの拡張子
+SKIP_EXTENSIONS = (
+    '.pdf', '.zip', '.jpg', '.jpeg', '.png', '.gif', '.webp', '.svg',
+    '.mp3', '.mp4', '.webm', '.css', '.js', '.json', '.xml',
+)
+
+
+def normalize_url(url: str) -> str | None:
+    """
+    巡回対象として扱えるURLに正規化します (フラグメントを除去)。
+    http(s) 以外のURLや、HTMLではないファイルへのリンクの場合は None を返します。
+    """
+    url, _ = urldefrag(url)
+    parsed = urlparse(url)
+    if parsed.scheme not in ('http', 'https') or not parsed.netloc:
+        return None
+    if parsed.path.lower().endswith(SKIP_EXTENSIONS):
+        return None
+    return url
+
+
+class RobotsCache:
+    """
+    ホストごとに robots.txt を一度だけ取得し、URLの巡回可否を判定します。
+    """
+
+    def __init__(self, session: requests.Session):
+        self.session = session
+        self._parsers: dict[str, RobotFileParser] = {}
+        self._lock = threading.Lock()
+
+    def _load(self, origin: str) -> RobotFileParser:
+        parser = RobotFileParser(urljoin(origin, '/robots.txt'))
+        try:
+            response = self.session.get(parser.url, timeout=10)
+        except requests.exceptions.RequestException as e:
+            print(f"robots.txt の取得中にエラーが発生しました ({parser.url}): {e}")
+            parser.parse([]) # 取得できない場合は制限なしとして扱う
+            return parser
+        # urllib.robotparser と同様に、401/403 は全拒否、その他の4xxは制限なしとして扱う
+        if response.status_code in (401, 403):
+            parser.disallow_all = True
+        elif response.status_code >= 400:
+            parser.allow_all = True
+        else:
+            parser.parse(response.text.splitlines())
+        return parser
+
+    def allowed(self, url: str) -> bool:
+        parsed = urlparse(url)
+        origin = f"{parsed.scheme}://{parsed.netloc}"
+        with self._lock:
+            parser = self._parsers.get(origin)
+            if parser is None:
+                parser = self._parsers[origin] = self._load(origin)
+        return parser.can_fetch(DEFAULT_HEADERS['User-Agent'], url)
+
+
+def crawl_site(
+    seed_url: str,
+    max_depth: int = 1,
+    max_pages: int = 20,
+    max_workers: int = 8,
+    per_host_concurrency: int = 4,
+    page_cache=None,
+) -> Iterator[dict]:
+    """
+    seed_url から同一ドメイン内のリンクを max_depth 階層までたどり、最大 max_pages ページを取得します。
+
+    取得と解析は最大 max_workers 並列 (同一ホストへは per_host_concurrency 並列まで) で行い、
+    解析が終わったページから順に `{'url': str, 'depth': int, 'parsed': dict}` を yield します。
+    page_cache (PageCache) が渡された場合は、キャッシュ経由でページを取得します。
+    """
+    seed_url = normalize_url(seed_url)
+    if seed_url is None:
+        return
+    domain = urlparse(seed_url).netloc
+    session = get_session()
+    robots = RobotsCache(session)
+    host_limits: dict[str, threading.BoundedSemaphore] = {}
+    host_limits_lock = threading.Lock()
+
+    def fetch_and_parse(url: str) -> dict | None:
+        host = urlparse(url).netloc
+        with host_limits_lock:
+            limit = host_limits.setdefault(host, threading.BoundedSemaphore(per_host_concurrency))
+        with limit:
+            if page_cache is not None:
+                return page_cache.get(url)
+            # ページ全体を保持せず、取得しながら解析する
+            result = fetch_and_parse_stream(url)
+        return result["parsed"] if result else None
+
+    if not robots.allowed(seed_url):
+        print(f"robots.txt により巡回が許可されていません: {seed_url}")
+        return
+
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def submit(url: str):
+        # 呼び出し元の計測 (instrumentation) の文脈を、ワーカースレッドにも引き継ぐ
+        return executor.submit(contextvars.copy_context().run, fetch_and_parse, url)
+
+    seen = {seed_url}
+    pending = {submit(seed_url): (seed_url, 0)}
+    try:
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                url, depth = pending.pop(future)
+                try:
+                    parsed = future.result()
+                except Exception as e:
+                    print(f"URL '{url}' の解析中にエラーが発生しました: {e}")
+                    continue
+                if parsed is None:
+                    continue
+
+                # 次の階層のリンクを、結果を返す前に投入しておく (取得と利用者側の処理を重ねるため)
+                if depth < max_depth:
+                    for link in parsed['links']:
+                        if len(seen) >= max_pages:
+                            break
+                        next_url = normalize_url(link['url'])
+                        if next_url is None or next_url in seen or urlparse(next_url).netloc != domain:
+                            continue
+                        seen.add(next_url)
+                        if robots.allowed(next_url):
+                            pending[submit(next_url)] = (next_url, depth + 1)
+
+                yield {'url': url, 'depth': depth, 'parsed': parsed}
+    finally:
+        # 途中で巡回をやめた場合も、未着手の取得はキャンセルする
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+if __name__ == '__main__':
+    # このスクリプトを直接実行した場合のテストコードです。
+    test_url = "https://www.nintendo.co.jp/zelda/totk/guide/"
+
+    print(f"--- サイトを巡回中: {test_url} ---")
+    for page in crawl_site(test_url, max_depth=1, max_pages=10):
+        print(f"[深さ{page['depth']}] {page['parsed']['title']} ({len(page['parsed']['body_text'])} 文字): {page['url']}")
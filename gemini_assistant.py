@@ -1,38 +1,116 @@
-import google.generativeai as genai
+import json
 import os
+import time
+from collections.abc import Iterator
 from dotenv import load_dotenv # python-dotenv ライブラリをインポート
+from gemini_client import get_client
+from instrumentation import current_trace, record, span
 
 # .envファイルを読み込む (スクリプトの先頭で呼び出すのが一般的)
 # これにより、.envファイルに定義された変数が os.environ に追加される
 # ただし、すでに環境変数として設定されている場合はそちらが優先される
 load_dotenv() 
 
+# 攻略情報（戦闘や武器の話題など）が不必要にブロックされないよう、全カテゴリでブロックを無効化する
+SAFETY_SETTINGS = [
+    {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
+]
+
+# 利用可能なモデル名のリストを保存するファイルと、その有効期限
+# モデル名の確認は起動のたびにネットワーク経由で行わず、このファイルを参照します。
+DEFAULT_MODEL_LIST_CACHE_PATH = ".cache/models.json"
+MODEL_LIST_CACHE_TTL_SECONDS = 24 * 60 * 60
+
+def _load_genai():
+    """
+    google.generativeai を読み込みます。
+    読み込みに時間がかかるため、モジュールの先頭ではなく実際に使うときに読み込みます。
+    """
+    import google.generativeai as genai
+    return genai
+
+def _model_list_cache_path() -> str:
+    return os.getenv("MODEL_LIST_CACHE_PATH", DEFAULT_MODEL_LIST_CACHE_PATH)
+
+def save_model_list_cache(model_names: list[str]) -> None:
+    """
+    利用可能なモデル名のリストをファイルに保存します。
+    """
+    path = _model_list_cache_path()
+    try:
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"fetched_at": time.time(), "models": model_names}, f)
+    except OSError as e:
+        print(f"モデルのリストの保存中にエラーが発生しました: {e}")
+
+def load_model_list_cache() -> list[str] | None:
+    """
+    保存済みのモデル名のリストを返します。ファイルがない場合や有効期限切れの場合は None を返します。
+    """
+    try:
+        with open(_model_list_cache_path(), encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if time.time() - data.get("fetched_at", 0) > MODEL_LIST_CACHE_TTL_SECONDS:
+        return None
+    return data.get("models")
+
 def list_available_models(api_key: str):
     """
     指定されたAPIキーで利用可能なGeminiモデルのリストを出力します。
-    generateContent メソッドをサポートするモデルのみを表示します。
+    generateContent メソッドをサポートするモデルのみを表示し、そのリストをファイルに保存します。
     """
+    genai = _load_genai()
     genai.configure(api_key=api_key)
     print("\n--- 利用可能なGeminiモデルのリスト ---")
     try:
+        model_names = []
         for m in genai.list_models():
             if 'generateContent' in m.supported_generation_methods:
                 print(f"Name: {m.name}, Display Name: {m.display_name}, Supported Methods: {m.supported_generation_methods}")
+                model_names.append(m.name)
+        save_model_list_cache(model_names)
     except Exception as e:
         print(f"モデルのリスト取得中にエラーが発生しました: {e}")
     print("--------------------------------------")
 
+def validate_model_name(model_name: str) -> bool | None:
+    """
+    モデル名が保存済みのモデルのリストに含まれているかを確認します（ネットワークには接続しません）。
+    保存済みのリストがない場合は、確認できないため None を返します。
+    """
+    model_names = load_model_list_cache()
+    if model_names is None:
+        return None
+    # リストのモデル名は 'models/' から始まるため、環境変数で省略されていれば補って比較する
+    if not model_name.startswith("models/"):
+        model_name = f"models/{model_name}"
+    return model_name in model_names
+
 
-def initialize_gemini_model(api_key: str):
+def initialize_gemini_model(api_key: str, model_name: str | None = None):
     """
     GeminiモデルをAPIキーで初期化します。
-    環境変数 GEMINI_MODEL_NAME があればそれを使用し、なければデフォルト値を使用します。
+    model_name を省略した場合は、環境変数 GEMINI_MODEL_NAME があればそれを使用し、なければデフォルト値を使用します。
+    （query_router.py の軽量なモデルなど、別のモデルを使う場合は model_name を指定します）
     """
+    genai = _load_genai()
     genai.configure(api_key=api_key)
     
     # 環境変数からモデル名を読み込む。設定されていなければ 'gemini-1.5-flash' をデフォルトとする。
     # このモデルは無料枠で利用できることが多い。
-    model_name = os.getenv("GEMINI_MODEL_NAME", "gemini-2.5-flash-preview-05-20")
+    model_name = model_name or os.getenv("GEMINI_MODEL_NAME", "gemini-2.5-flash-preview-05-20")
+
+    # 保存済みのモデルのリストがあれば、存在しないモデル名をここで検出する
+    if validate_model_name(model_name) is False:
+        print(f"Geminiモデル '{model_name}' は利用可能なモデルのリストにありません。モデル名の設定を確認してください。")
+        return None
 
     try:
         model = genai.GenerativeModel(model_name=model_name)
@@ -42,27 +120,107 @@ def initialize_gemini_model(api_key: str):
         print(f"Geminiモデルの初期化中にエラーが発生しました。APIキーが正しいか、またはモデル名'{model_name}'が利用可能か確認してください: {e}")
         return None
 
+class StreamInterruptedError(Exception):
+    """
+    回答のストリーミングが途中で失敗し、回答が最後まで届かなかったことを示します。
+    """
+
 def ask_gemini(model, conversation_history: list[dict]) -> str | None:
     """
     会話履歴全体をGeminiモデルに渡し、回答を取得します。
+    呼び出しは共有クライアント（gemini_client.py）を経由し、一時的なエラーはリトライされます。
     """
     try:
-        response = model.generate_content(
-            contents=conversation_history,
-            safety_settings=[
-                {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
-                {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
-                {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
-                {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
-            ]
-        )
+        with span("generate"):
+            response = get_client().generate_sync(
+                model,
+                conversation_history,
+                safety_settings=SAFETY_SETTINGS,
+            )
+        _record_usage(response)
         return response.text
     except Exception as e:
+        record("error", str(e))
         print(f"Gemini API呼び出し中にエラーが発生しました: {e}")
         print("APIキーが正しいか、ネットワーク接続を確認してください。")
         print("また、プロンプトの長さがモデルの最大トークン制限を超えていないか確認してください。")
         return None
 
+def _record_usage(response) -> None:
+    """
+    レスポンスの usage_metadata から、プロンプトと回答のトークン数を計測結果に記録します。
+    """
+    usage = getattr(response, "usage_metadata", None)
+    if usage:
+        record("prompt_tokens", usage.prompt_token_count)
+        record("response_tokens", usage.candidates_token_count)
+
+def _chunk_text(chunk) -> str:
+    """
+    ストリーミングの各チャンクからテキストを取り出します。
+    テキストを含まないチャンク（終了通知など）では chunk.text が ValueError を送出するため、空文字を返します。
+    """
+    try:
+        return chunk.text
+    except ValueError:
+        return ""
+
+def ask_gemini_stream(model, conversation_history: list[dict]) -> Iterator[str]:
+    """
+    会話履歴全体をGeminiモデルに渡し、回答をストリーミングで取得します。
+    生成されたテキストを届いた順にチャンク単位で yield します。
+    最初のチャンクを受け取るまでの一時的なエラーは、共有クライアントによってリトライされます。
+    最初のテキストが届く前にエラーが発生した場合はメッセージを出力し、何も返さずにストリームを終了します。
+    テキストが届き始めた後にエラーが発生した場合は、回答が不完全であることを示すため StreamInterruptedError を送出します。
+    """
+    trace = current_trace()
+    start = time.perf_counter()
+    first_token_at = None
+    last_chunk = None
+    received_text = False
+    try:
+        response = get_client().stream_sync(
+            model,
+            conversation_history,
+            safety_settings=SAFETY_SETTINGS,
+        )
+        for chunk in response:
+            last_chunk = chunk
+            text = _chunk_text(chunk)
+            if text:
+                if first_token_at is None:
+                    first_token_at = time.perf_counter()
+                    if trace:
+                        trace.add_span("time_to_first_token", start, first_token_at)
+                received_text = True
+                yield text
+    except Exception as e:
+        record("error", str(e))
+        print(f"Gemini API（ストリーミング）呼び出し中にエラーが発生しました: {e}")
+        print("APIキーが正しいか、ネットワーク接続を確認してください。")
+        print("また、プロンプトの長さがモデルの最大トークン制限を超えていないか確認してください。")
+        if received_text:
+            raise StreamInterruptedError(str(e)) from e
+    finally:
+        if trace:
+            trace.add_span("generate", start, time.perf_counter())
+        # トークン数は最後のチャンクの usage_metadata に含まれる
+        if last_chunk is not None:
+            _record_usage(last_chunk)
+
+def embed_texts(texts: list[str]) -> list[list[float]] | None:
+    """
+    テキストのリストを埋め込みベクトルのリストに変換します。
+    環境変数 GEMINI_EMBEDDING_MODEL_NAME のモデルを使用します（未設定の場合は 'models/text-embedding-004'）。
+    """
+    model_name = os.getenv("GEMINI_EMBEDDING_MODEL_NAME", "models/text-embedding-004")
+    try:
+        result = _load_genai().embed_content(model=model_name, content=texts)
+        return result["embedding"]
+    except Exception as e:
+        print(f"埋め込みの取得中にエラーが発生しました (モデル: '{model_name}'): {e}")
+        return None
+
 if __name__ == '__main__':
     # このブロックは、このスクリプトを直接実行した場合にのみ実行されます。
     # Streamlitアプリから呼ばれる場合は実行されません。
@@ -0,0 +1,262 @@
+"""
+Gemini API 呼び出しの非同期クライアントです。
+プロセス内のすべてのStreamlitセッションで1つのクライアント（専用のイベントループ）を共有し、
+
+- 一時的なエラー（429 / 5xx / タイムアウト）のジッター付き指数バックオフによるリトライ
+- APIの割り当てに合わせたトークンバケットによるレート制限
+- 同時実行数の上限
+- 同一内容のリクエストが同時に進行中の場合の結果の共有（リクエストの合流。ストリーミングでは1つのストリームを複数の呼び出し元に配信）
+
+を行います。同期コード（gemini_assistant.py の ask_gemini など）からは generate_sync / stream_sync を使います。
+"""
+import asyncio
+import hashlib
+import json
+import queue
+import random
+import threading
+import time
+from collections.abc import AsyncIterator, Iterator
+from functools import cache
+
+from config import env_number
+
+DEFAULT_REQUESTS_PER_MINUTE = 60
+DEFAULT_MAX_CONCURRENCY = 8
+DEFAULT_MAX_RETRIES = 4
+BACKOFF_BASE_SECONDS = 1.0
+BACKOFF_MAX_SECONDS = 30.0
+
+
+@cache
+def retryable_exceptions() -> tuple[type[Exception], ...]:
+    """
+    リトライすると成功する可能性がある一時的なエラーの型を返します。
+    起動時間を短くするため、google.api_core は最初のAPI呼び出し時に読み込みます。
+    """
+    from google.api_core import exceptions as google_exceptions
+    return (
+        google_exceptions.TooManyRequests,      # 429
+        google_exceptions.ResourceExhausted,    # 429 (割り当て超過)
+        google_exceptions.InternalServerError,  # 500
+        google_exceptions.ServiceUnavailable,   # 503
+        google_exceptions.DeadlineExceeded,     # 504 / タイムアウト
+    )
+
+
+class TokenBucket:
+    """
+    1秒あたり rate 個のトークンが補充され、最大 capacity 個まで貯まるトークンバケットです。
+    リクエストの送信前に1個消費し、トークンがなければ補充されるまで待ちます。
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+                self._updated_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class SharedStream:
+    """
+    1つのストリーミングの応答を、同じリクエストを待っている複数の呼び出し元に配信します。
+    受け取ったチャンクはすべて保持するため、途中から参加した呼び出し元にも最初のチャンクから順に渡します。
+    すべての呼び出し元が読むのをやめた場合は、元のストリームを打ち切ります。
+    """
+
+    def __init__(self):
+        self.chunks: list = []
+        self.done = False
+        self.error: BaseException | None = None
+        self.subscribers = 0
+        self.task: asyncio.Task | None = None
+        self._changed = asyncio.Event()
+
+    def _notify(self) -> None:
+        # 待っている呼び出し元を起こし、次の変化を待つためのイベントに差し替える
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def run(self, source: AsyncIterator) -> None:
+        try:
+            async for chunk in source:
+                self.chunks.append(chunk)
+                self._notify()
+        except asyncio.CancelledError:
+            self.error = RuntimeError("共有していたストリームが打ち切られました")
+            raise
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done = True
+            self._notify()
+
+    async def subscribe(self) -> AsyncIterator:
+        self.subscribers += 1
+        try:
+            index = 0
+            while True:
+                if index < len(self.chunks):
+                    yield self.chunks[index]
+                    index += 1
+                elif self.done:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                else:
+                    await self._changed.wait()
+        finally:
+            self.subscribers -= 1
+            if not self.subscribers and not self.done and self.task is not None:
+                self.task.cancel()
+
+
+class AsyncGeminiClient:
+    """
+    GenerativeModel の非同期APIを、リトライ・レート制限・同時実行数の制御付きで呼び出すクライアントです。
+    asyncio のロックやセマフォはイベントループごとに使う必要があるため、専用のスレッドで動くイベントループ上で処理します。
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: int | None = None,
+        max_concurrency: int | None = None,
+        max_retries: int | None = None,
+    ):
+        # 0 や負の値ではレート制限やセマフォが機能しないため、下限を設ける
+        requests_per_minute = max(requests_per_minute or env_number("GEMINI_REQUESTS_PER_MINUTE", DEFAULT_REQUESTS_PER_MINUTE), 1)
+        self.max_retries = max(max_retries if max_retries is not None else env_number("GEMINI_MAX_RETRIES", DEFAULT_MAX_RETRIES), 0)
+        # 一度に大量のリクエストが送られないよう、バケットの容量は同時実行数程度に抑える
+        max_concurrency = max(max_concurrency or env_number("GEMINI_MAX_CONCURRENCY", DEFAULT_MAX_CONCURRENCY), 1)
+        self._bucket = TokenBucket(rate=requests_per_minute / 60, capacity=max_concurrency)
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._inflight: dict[str, asyncio.Future] = {}
+        self._inflight_streams: dict[str, SharedStream] = {}
+
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="gemini-client", daemon=True)
+        self._thread.start()
+
+    @staticmethod
+    def _request_key(model, contents, kwargs: dict) -> str:
+        payload = json.dumps([model.model_name, contents, kwargs], ensure_ascii=False, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    async def _with_retry(self, call):
+        """
+        一時的なエラーの場合、ジッター付きの指数バックオフで待ってからリトライします。
+        """
+        for attempt in range(self.max_retries + 1):
+            await self._bucket.acquire()
+            try:
+                return await call()
+            except retryable_exceptions() as e:
+                if attempt == self.max_retries:
+                    raise
+                # フルジッター: 0〜(基準時間 × 2^試行回数) の範囲でランダムに待つことで、リトライの集中を避ける
+                delay = random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+                print(f"Gemini APIの一時的なエラーのため、{delay:.1f}秒後にリトライします ({attempt + 1}/{self.max_retries}): {e}")
+                await asyncio.sleep(delay)
+
+    async def _generate(self, model, contents, kwargs: dict):
+        async with self._semaphore:
+            return await self._with_retry(lambda: model.generate_content_async(contents=contents, **kwargs))
+
+    async def generate(self, model, contents: list[dict], **kwargs):
+        """
+        回答を生成し、レスポンスを返します。
+        同じモデル・同じ内容のリクエストが進行中の場合は、新たに送信せずその結果を共有します。
+        """
+        key = self._request_key(model, contents, kwargs)
+        future = self._inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._generate(model, contents, kwargs))
+            self._inflight[key] = future
+            future.add_done_callback(lambda _: self._inflight.pop(key, None))
+        # 待っている側がキャンセルされても、共有している他の呼び出し元には影響させない
+        return await asyncio.shield(future)
+
+    async def _stream(self, model, contents, kwargs: dict) -> AsyncIterator:
+        async with self._semaphore:
+            response = await self._with_retry(
+                lambda: model.generate_content_async(contents=contents, stream=True, **kwargs)
+            )
+            async for chunk in response:
+                yield chunk
+
+    async def stream(self, model, contents: list[dict], **kwargs) -> AsyncIterator:
+        """
+        回答をストリーミングで生成し、チャンクを順に yield します。
+        リトライは最初のチャンクを受け取るまでの間だけ行います（表示済みの内容を重複させないため）。
+        同じモデル・同じ内容のストリーミングが進行中の場合は、新たに送信せずそのストリームのチャンクを共有します。
+        """
+        key = self._request_key(model, contents, dict(kwargs, stream=True))
+        shared = self._inflight_streams.get(key)
+        if shared is None:
+            shared = SharedStream()
+            shared.task = asyncio.ensure_future(shared.run(self._stream(model, contents, kwargs)))
+            self._inflight_streams[key] = shared
+            shared.task.add_done_callback(lambda _: self._inflight_streams.pop(key, None))
+        async for chunk in shared.subscribe():
+            yield chunk
+
+    def generate_sync(self, model, contents: list[dict], **kwargs):
+        """
+        generate の同期版です。呼び出し元のスレッドは結果が返るまで待ちます。
+        """
+        return asyncio.run_coroutine_threadsafe(self.generate(model, contents, **kwargs), self._loop).result()
+
+    def stream_sync(self, model, contents: list[dict], **kwargs) -> Iterator:
+        """
+        stream の同期版です。イベントループ側で受け取ったチャンクをキューで受け渡し、順に yield します。
+        """
+        chunks: queue.Queue = queue.Queue()
+
+        async def pump():
+            try:
+                async for chunk in self.stream(model, contents, **kwargs):
+                    chunks.put(("chunk", chunk))
+                chunks.put(("done", None))
+            except Exception as e:
+                chunks.put(("error", e))
+
+        future = asyncio.run_coroutine_threadsafe(pump(), self._loop)
+        try:
+            while True:
+                kind, value = chunks.get()
+                if kind == "done":
+                    return
+                if kind == "error":
+                    raise value
+                yield value
+        finally:
+            # 呼び出し元が途中で読むのをやめた場合は、ストリームを打ち切る
+            future.cancel()
+
+
+_client: AsyncGeminiClient | None = None
+_client_lock = threading.Lock()
+
+
+def get_client() -> AsyncGeminiClient:
+    """
+    プロセス全体で共有するクライアントを返します（初回呼び出し時に作成）。
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = AsyncGeminiClient()
+    return _client
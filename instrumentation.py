@@ -0,0 +1,245 @@
+"""
+リクエストごとの処理時間とトークン数を計測するモジュールです。
+
+1回の処理（質問への回答など）を Trace として記録し、その中の各段階（ページ取得、解析、履歴の構築、
+最初のトークンまでの時間、生成全体）を span として計測します。Trace が終わると、設定されたシンクに送られます。
+
+- JsonLinesSink: 1 Trace を1行のJSONとしてファイルに追記します。
+- PrometheusSink: span ごとの回数と合計時間、トークン数を集計し、Prometheus のテキスト形式で公開します。
+
+使用するシンクは環境変数 TRACE_SINKS（例: "jsonl,prometheus"）で指定します。
+現在の Trace は contextvars で管理されるため、各モジュールは span() / record() を呼ぶだけで計測できます。
+"""
+import contextvars
+import functools
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from config import env_number
+
+DEFAULT_TRACE_LOG_PATH = ".cache/traces.jsonl"
+
+_current_trace: contextvars.ContextVar["Trace | None"] = contextvars.ContextVar("current_trace", default=None)
+
+
+class Trace:
+    """
+    1回の処理の計測結果です。spans には各段階の開始時刻（Trace開始からのミリ秒）と所要時間が入ります。
+    """
+
+    def __init__(self, name: str, attributes: dict | None = None):
+        self.name = name
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.started_at = time.time()
+        self.attributes = dict(attributes or {})
+        self.spans: list[dict] = []
+        self.duration_ms: float | None = None
+        self._start = time.perf_counter()
+
+    def add_span(self, name: str, start: float, end: float) -> None:
+        """
+        time.perf_counter() で計測した開始・終了時刻から span を記録します。
+        """
+        self.spans.append({
+            "name": name,
+            "start_ms": round((start - self._start) * 1000, 2),
+            "duration_ms": round((end - start) * 1000, 2),
+        })
+
+    @contextmanager
+    def span(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_span(name, start, time.perf_counter())
+
+    def finish(self) -> None:
+        self.duration_ms = round((time.perf_counter() - self._start) * 1000, 2)
+
+    def to_dict(self) -> dict:
+        return {
+            "trace_id": self.trace_id,
+            "name": self.name,
+            "started_at": self.started_at,
+            "duration_ms": self.duration_ms,
+            "attributes": self.attributes,
+            "spans": self.spans,
+        }
+
+
+class JsonLinesSink:
+    """
+    Trace を1行のJSONとしてファイルに追記するシンクです。
+    """
+
+    def __init__(self, path: str | None = None):
+        self.path = path or os.getenv("TRACE_LOG_PATH", DEFAULT_TRACE_LOG_PATH)
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._lock = threading.Lock()
+
+    def emit(self, trace: Trace) -> None:
+        line = json.dumps(trace.to_dict(), ensure_ascii=False)
+        with self._lock:
+            try:
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(line + "\n")
+            except OSError as e:
+                print(f"計測結果の書き込み中にエラーが発生しました ({self.path}): {e}")
+
+
+class PrometheusSink:
+    """
+    span ごとの回数と合計時間、Trace ごとの回数、トークン数の合計を集計するシンクです。
+    render() で Prometheus のテキスト形式を返し、serve() でHTTPエンドポイントとして公開します。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._span_counts: dict[str, int] = {}
+        self._span_seconds: dict[str, float] = {}
+        self._trace_counts: dict[str, int] = {}
+        self._tokens: dict[str, int] = {}
+
+    def emit(self, trace: Trace) -> None:
+        with self._lock:
+            self._trace_counts[trace.name] = self._trace_counts.get(trace.name, 0) + 1
+            for span in trace.spans:
+                self._span_counts[span["name"]] = self._span_counts.get(span["name"], 0) + 1
+                self._span_seconds[span["name"]] = self._span_seconds.get(span["name"], 0.0) + span["duration_ms"] / 1000
+            for kind in ("prompt_tokens", "response_tokens"):
+                if kind in trace.attributes:
+                    self._tokens[kind] = self._tokens.get(kind, 0) + int(trace.attributes[kind])
+
+    def render(self) -> str:
+        with self._lock:
+            lines = ["# TYPE game_assistant_traces_total counter"]
+            lines += [f'game_assistant_traces_total{{trace="{name}"}} {count}' for name, count in sorted(self._trace_counts.items())]
+            lines.append("# TYPE game_assistant_span_seconds summary")
+            for name in sorted(self._span_counts):
+                lines.append(f'game_assistant_span_seconds_count{{span="{name}"}} {self._span_counts[name]}')
+                lines.append(f'game_assistant_span_seconds_sum{{span="{name}"}} {self._span_seconds[name]:.6f}')
+            lines.append("# TYPE game_assistant_tokens_total counter")
+            lines += [f'game_assistant_tokens_total{{kind="{kind}"}} {count}' for kind, count in sorted(self._tokens.items())]
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port: int) -> None:
+        """
+        /metrics で集計結果を返すHTTPサーバーを、バックグラウンドのスレッドで起動します。
+        """
+        sink = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = sink.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass # アクセスごとのログは出力しない
+
+        try:
+            server = ThreadingHTTPServer(("0.0.0.0", port), MetricsHandler)
+        except (OSError, OverflowError) as e:
+            print(f"メトリクスのエンドポイント (ポート {port}) を起動できませんでした: {e}")
+            return
+        threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+
+
+_sinks: list | None = None
+_sinks_lock = threading.Lock()
+
+
+def get_sinks() -> list:
+    """
+    環境変数 TRACE_SINKS に従ってシンクを作成し、プロセス全体で共有します。
+    METRICS_PORT が設定されている場合は、Prometheus 形式のエンドポイントも起動します。
+    """
+    global _sinks
+    if _sinks is None:
+        with _sinks_lock:
+            if _sinks is None:
+                sinks = []
+                names = {name.strip() for name in os.getenv("TRACE_SINKS", "").split(",") if name.strip()}
+                if "jsonl" in names:
+                    sinks.append(JsonLinesSink())
+                if "prometheus" in names:
+                    prometheus = PrometheusSink()
+                    metrics_port = env_number("METRICS_PORT", 0)
+                    if metrics_port:
+                        prometheus.serve(metrics_port)
+                    sinks.append(prometheus)
+                _sinks = sinks
+    return _sinks
+
+
+@contextmanager
+def start_trace(name: str, **attributes):
+    """
+    新しい Trace を開始し、このブロック内で呼ばれた span() / record() の結果をまとめます。
+    ブロックを抜けると Trace を終了してシンクに送ります。
+    計測の設定や出力先のエラーで本来の処理が失敗しないよう、シンクへの送信で発生した例外は出力するだけにします。
+    """
+    trace = Trace(name, attributes)
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+        trace.finish()
+        try:
+            for sink in get_sinks():
+                sink.emit(trace)
+        except Exception as e:
+            print(f"計測結果の送信中にエラーが発生しました ({trace.name}): {e}")
+
+
+def current_trace() -> Trace | None:
+    return _current_trace.get()
+
+
+@contextmanager
+def span(name: str):
+    """
+    現在の Trace に span を記録します。Trace が開始されていない場合は何もしません。
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+    with trace.span(name):
+        yield
+
+
+def traced(name: str):
+    """
+    関数の呼び出し全体を span として記録するデコレータです。
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def record(key: str, value) -> None:
+    """
+    現在の Trace に属性（トークン数やキャッシュのヒットなど）を記録します。
+    """
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.attributes[key] = value
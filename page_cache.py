@@ -0,0 +1,117 @@
+"""
+スクレイピングしたページの解析結果を、URLごとにディスクへキャッシュするモジュールです。
+TTL内のキャッシュはそのまま再利用し、TTLを過ぎたものは ETag / Last-Modified で再検証します。
+多くのユーザーが同じ攻略ページを参照するため、ダウンロードと解析の重複を避けることができます。
+"""
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+from config import env_number
+from web_scraper import fetch_and_parse_stream
+
+# キャッシュの保存先と有効期限（環境変数で上書き可能）
+DEFAULT_PAGE_CACHE_DIR = ".cache/pages"
+DEFAULT_PAGE_CACHE_TTL_SECONDS = 6 * 60 * 60 # この時間内は再検証せずにキャッシュを返す
+DEFAULT_PAGE_CACHE_MAX_AGE_SECONDS = 7 * 24 * 60 * 60 # この時間アクセスされなかったキャッシュは削除する
+
+# 期限切れキャッシュの削除を行う間隔
+EVICTION_INTERVAL_SECONDS = 60 * 60
+
+
+class PageCache:
+    """
+    URLをキーに、parse_html_content の結果をJSONファイルとして保存するキャッシュです。
+    1エントリ = 1ファイルで、ファイル名はURLのSHA-256ハッシュです。
+    """
+
+    def __init__(self, cache_dir: str | None = None, ttl_seconds: int | None = None, max_age_seconds: int | None = None):
+        self.cache_dir = cache_dir or os.getenv("PAGE_CACHE_DIR", DEFAULT_PAGE_CACHE_DIR)
+        self.ttl_seconds = ttl_seconds if ttl_seconds is not None else env_number("PAGE_CACHE_TTL_SECONDS", DEFAULT_PAGE_CACHE_TTL_SECONDS)
+        self.max_age_seconds = max_age_seconds if max_age_seconds is not None else env_number("PAGE_CACHE_MAX_AGE_SECONDS", DEFAULT_PAGE_CACHE_MAX_AGE_SECONDS)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._last_evicted = 0.0
+        self.evict_expired()
+
+    def _path(self, url: str) -> str:
+        return os.path.join(self.cache_dir, hashlib.sha256(url.encode("utf-8")).hexdigest() + ".json")
+
+    def _load(self, url: str) -> dict | None:
+        try:
+            with open(self._path(url), encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            print(f"ページキャッシュの読み込み中にエラーが発生しました ({url}): {e}")
+            return None
+
+    def _save(self, url: str, entry: dict) -> None:
+        # 書き込み途中のファイルを他のプロセスが読まないよう、一時ファイルに書いてから置き換える
+        # (同じプロセスの複数のセッションのスレッドが同じURLを同時に保存しても衝突しないよう、一時ファイル名は毎回作る)
+        path = self._path(url)
+        tmp_path = None
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(entry, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"ページキャッシュの保存中にエラーが発生しました ({url}): {e}")
+            if tmp_path and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def get(self, url: str) -> dict | None:
+        """
+        URLの解析結果（parse_html_content の戻り値）を返します。
+        キャッシュがTTL内ならそのまま返し、期限切れなら条件付きリクエストで再検証します。
+        取得に失敗した場合は、古いキャッシュがあればそれを返し、なければ None を返します。
+        """
+        now = time.time()
+        if now - self._last_evicted > EVICTION_INTERVAL_SECONDS:
+            self.evict_expired()
+
+        entry = self._load(url)
+        if entry and now - entry["fetched_at"] < self.ttl_seconds:
+            return entry["parsed"]
+
+        result = fetch_and_parse_stream(
+            url,
+            etag=entry.get("etag") if entry else None,
+            last_modified=entry.get("last_modified") if entry else None,
+        )
+        if result is None:
+            return entry["parsed"] if entry else None
+
+        if result["status"] == 304 and entry:
+            # ページは更新されていないため、解析済みの結果をそのまま使い、取得日時だけ更新する
+            entry["fetched_at"] = now
+        else:
+            entry = {
+                "url": url,
+                "fetched_at": now,
+                "etag": result["etag"],
+                "last_modified": result["last_modified"],
+                "parsed": result["parsed"],
+            }
+        self._save(url, entry)
+        return entry["parsed"]
+
+    def evict_expired(self) -> None:
+        """
+        max_age_seconds 以上更新されていないキャッシュファイルを削除します。
+        """
+        self._last_evicted = time.time()
+        try:
+            names = os.listdir(self.cache_dir)
+        except OSError:
+            return
+        for name in names:
+            path = os.path.join(self.cache_dir, name)
+            try:
+                if self._last_evicted - os.path.getmtime(path) > self.max_age_seconds:
+                    os.remove(path)
+            except OSError:
+                continue
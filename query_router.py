@@ -0,0 +1,172 @@
+"""
+質問の内容に応じて、回答の経路（ルート）を選ぶモジュールです。
+
+- cache: 回答キャッシュにある質問は、モデルを呼ばずにキャッシュの回答を返します。
+- retrieval: 参照サイトの1つのチャンクで答えられる調べもの（場所や入手方法など）は、モデルを呼ばずにその部分を引用して返します。
+  しきい値の調整が必要なため、環境変数 ROUTER_RETRIEVAL_DIRECT_MIN_COVERAGE を設定した場合のみ使います（最初の質問では使いません）。
+- fast: 短い追加の質問は、軽量なモデル（環境変数 GEMINI_FAST_MODEL_NAME）に問い合わせます。
+- heavy: 攻略の手順や比較など、複雑な質問だけを通常のモデル（GEMINI_MODEL_NAME）に問い合わせます。
+
+GEMINI_FAST_MODEL_NAME が設定されていない場合、fast の質問も通常のモデルに問い合わせます。
+判定の結果は計測（instrumentation.py）の Trace に記録し、コンソールにも出力するため、しきい値の調整に使えます。
+"""
+import os
+import re
+
+from config import env_number
+from instrumentation import record
+from response_cache import normalize_question
+from retrieval_index import CHUNK_SIZE, tokenize
+
+ROUTE_CACHE = "cache"
+ROUTE_RETRIEVAL = "retrieval"
+ROUTE_FAST = "fast"
+ROUTE_HEAVY = "heavy"
+
+# 短い追加の質問とみなす、正規化後の最大文字数
+FAST_MAX_CHARS = 40
+# これより長い質問は、複雑な質問として通常のモデルに送る
+HEAVY_MIN_CHARS = 120
+
+# 複雑な質問（手順や比較、理由の説明が必要なもの）を示す表現
+HEAVY_MARKERS = (
+    "攻略手順", "手順", "順番", "比較", "違い", "なぜ", "理由", "戦略", "立ち回り", "編成", "ビルド",
+    "効率", "最適", "おすすめ", "どうすれば", "どうやって", "詳しく", "まとめて",
+)
+# 参照サイトの該当箇所をそのまま示せば答えられる、調べものの質問を示す表現
+LOOKUP_MARKERS = (
+    "どこ", "場所", "入手方法", "入手場所", "手に入", "いくら", "値段", "何個", "何体", "何回",
+    "ステータス", "効果", "素材", "出現", "報酬",
+)
+# 質問の言い回しの部分（キーワードの照合から除く）
+QUESTION_PHRASES = re.compile(
+    r"について|を?教えて(ください)?|ください|ですか|ますか|でしょうか|ありますか|知りたい|"
+    r"どこ(にある|で|に)?|入手方法|入手場所|場所|手に入(る|れる)|いくら|値段|何個|何体|何回|は？|\?|？"
+)
+
+# 調べものの質問の表現と、その答えになっていることを示すチャンク側の表現
+# (名前が出てくるだけの文ではなく、場所や数値などの答えを含む文だけを根拠として扱う)
+LOOKUP_EVIDENCE = (
+    (("どこ", "場所", "入手方法", "入手場所", "手に入", "出現"), re.compile(r"場所|入手|手に入|付近|周辺|地方|エリア|宝箱|ドロップ|販売|出現|報酬")),
+    (("いくら", "値段"), re.compile(r"\d+\s*(円|ルピー|ゴールド|G)|価格|値段")),
+    (("何個", "何体", "何回"), re.compile(r"\d+\s*(個|体|回|つ)")),
+    (("ステータス",), re.compile(r"攻撃力|防御力|HP|MP|ステータス")),
+    (("効果",), re.compile(r"効果|上昇|アップ|回復|軽減|無効")),
+    (("素材",), re.compile(r"素材|必要")),
+    (("報酬",), re.compile(r"報酬|もらえ|入手")),
+)
+# チャンクを文に分割する (句点などの直後、または改行で区切る)
+SENTENCE_BOUNDARY = re.compile(r"(?<=[。！？!?])|\n")
+
+# 参照サイトのチャンクだけで回答する場合に、質問のキーワード（文字バイグラム）のうち根拠の文に含まれる割合の下限
+# (0 の場合は retrieval ルートを使わない。しきい値の調整が済むまでは既定で無効)
+DEFAULT_RETRIEVAL_DIRECT_MIN_COVERAGE = 0.0
+RETRIEVAL_DIRECT_MIN_KEY_TOKENS = 2
+
+
+def _retrieval_direct_min_coverage() -> float | None:
+    """
+    環境変数 ROUTER_RETRIEVAL_DIRECT_MIN_COVERAGE を読み込みます。0 の場合は retrieval ルートを使いません。
+    """
+    coverage = env_number("ROUTER_RETRIEVAL_DIRECT_MIN_COVERAGE", DEFAULT_RETRIEVAL_DIRECT_MIN_COVERAGE, float)
+    return coverage if coverage > 0 else None
+
+
+def get_fast_model_name() -> str | None:
+    """
+    軽量なモデルの名前（環境変数 GEMINI_FAST_MODEL_NAME）を返します。未設定の場合は None です。
+    """
+    return os.getenv("GEMINI_FAST_MODEL_NAME") or None
+
+
+def classify_question(question: str, is_first_turn: bool) -> tuple[str, str]:
+    """
+    モデルに問い合わせる質問を、fast か heavy に分類します。戻り値は (ルート, 理由) です。
+    """
+    normalized = normalize_question(question)
+    if len(normalized) >= HEAVY_MIN_CHARS:
+        return ROUTE_HEAVY, f"long ({len(normalized)} chars)"
+    marker = next((marker for marker in HEAVY_MARKERS if marker in normalized), None)
+    if marker:
+        return ROUTE_HEAVY, f"complex marker '{marker}'"
+    if question.count("？") + question.count("?") >= 2:
+        return ROUTE_HEAVY, "multiple questions"
+    if is_first_turn:
+        # 最初の質問は会話の方向を決めるため、短くても通常のモデルに送る
+        return ROUTE_HEAVY, "first turn"
+    if len(normalized) <= FAST_MAX_CHARS:
+        return ROUTE_FAST, f"short follow-up ({len(normalized)} chars)"
+    return ROUTE_HEAVY, "default"
+
+
+def _evidence_sentences(question: str, text: str) -> list[str]:
+    """
+    チャンクの文のうち、質問の調べもの（場所や数値など）の答えを含む文を返します。
+    チャンクの末尾で途中から切れている文は含めません。
+    """
+    patterns = [pattern for markers, pattern in LOOKUP_EVIDENCE if any(marker in question for marker in markers)]
+    sentences = [sentence.strip() for sentence in SENTENCE_BOUNDARY.split(text)]
+    if len(text) >= CHUNK_SIZE and sentences and not re.search(r"[。！？!?]$", sentences[-1]):
+        sentences.pop()
+    return [sentence for sentence in sentences if sentence and any(pattern.search(sentence) for pattern in patterns)]
+
+
+def answer_from_chunks(question: str, chunks: list[dict]) -> tuple[str, float] | None:
+    """
+    調べものの質問で、最上位のチャンクにその答えを含む文があり、その文に質問のキーワードがほぼすべて含まれている場合は、
+    その文を引用した回答と、キーワードの一致率を返します。条件を満たさない場合は None を返します。
+    """
+    min_coverage = _retrieval_direct_min_coverage()
+    if min_coverage is None or not chunks:
+        return None
+    normalized = normalize_question(question)
+    if not any(marker in normalized for marker in LOOKUP_MARKERS):
+        return None
+    key_tokens = set(tokenize(QUESTION_PHRASES.sub(" ", question)))
+    if len(key_tokens) < RETRIEVAL_DIRECT_MIN_KEY_TOKENS:
+        return None
+
+    top = chunks[0]
+    evidence = _evidence_sentences(normalized, top["text"])
+    if not evidence:
+        return None
+    coverage = len(key_tokens & set(tokenize("".join(evidence)))) / len(key_tokens)
+    if coverage < min_coverage:
+        return None
+    quoted = "\n".join(f"> {sentence}" for sentence in evidence)
+    answer = (
+        "参照サイトに該当する情報がありました（AIによる要約は行わず、該当箇所をそのまま引用しています）。\n\n"
+        f"{quoted}\n\n"
+        f"出典: [{top['title']}]({top['url']})"
+    )
+    return answer, coverage
+
+
+def route_question(
+    question: str,
+    is_first_turn: bool,
+    cached_answer: str | None = None,
+    chunks: list[dict] | None = None,
+) -> dict:
+    """
+    質問の回答経路を決めます。
+    戻り値: {'route': str, 'reason': str, 'answer': str | None, 'model_name': str | None}
+    （cache / retrieval の場合は answer に回答が入り、fast / heavy の場合は問い合わせるモデル名が入ります）
+    """
+    if cached_answer:
+        decision = {"route": ROUTE_CACHE, "reason": "response cache hit", "answer": cached_answer, "model_name": None}
+    elif not is_first_turn and (direct := answer_from_chunks(question, chunks or [])):
+        # 最初の質問は会話の方向を決めるため、引用だけで済ませず通常のモデルに送る
+        answer, coverage = direct
+        decision = {"route": ROUTE_RETRIEVAL, "reason": f"lookup answered by top chunk ({coverage:.2f})", "answer": answer, "model_name": None}
+    else:
+        route, reason = classify_question(question, is_first_turn)
+        model_name = get_fast_model_name() if route == ROUTE_FAST else None
+        if route == ROUTE_FAST and model_name is None:
+            reason += ", GEMINI_FAST_MODEL_NAME not set"
+        decision = {"route": route, "reason": reason, "answer": None, "model_name": model_name}
+
+    record("route", decision["route"])
+    record("route_reason", decision["reason"])
+    print(f"[query_router] route={decision['route']} reason={decision['reason']} question={question[:40]!r}")
+    return decision
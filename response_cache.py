@@ -0,0 +1,209 @@
+"""
+Geminiの回答を、(モデル名, ゲーム名, 参照URL, 正規化した質問) をキーにSQLiteへキャッシュするモジュールです。
+同じゲームについて同じ質問が繰り返されたとき、APIを呼び出さずにすぐ回答を返します。
+会話の文脈に依存する質問の回答を使い回さないよう、キャッシュの対象は最初の質問と文脈に依存しない質問に限ります。
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+
+from config import env_number
+
+DEFAULT_RESPONSE_CACHE_PATH = ".cache/responses.sqlite3"
+DEFAULT_RESPONSE_CACHE_TTL_SECONDS = 7 * 24 * 60 * 60
+DEFAULT_RESPONSE_CACHE_MAX_ENTRIES = 5000
+DEFAULT_RESPONSE_CACHE_MAX_BYTES = 50 * 1024 * 1024
+
+# 類似質問の照合で、1つのキャッシュ範囲から比較する最大件数（新しい順）
+NEAR_DUPLICATE_SCAN_LIMIT = 500
+
+# 2回目以降の質問で、前の会話を指していると判断する表現
+CONTEXT_DEPENDENT_MARKERS = (
+    "それ", "その", "これ", "この", "あれ", "あの", "さっき", "先ほど", "上記", "前の", "続き",
+    "もっと", "他には", "ほかには", "じゃあ", "詳しく",
+)
+# 2回目以降の質問で、キャッシュの対象とする正規化後の最小文字数（短い質問は文脈に依存しやすいため）
+CONTEXT_INDEPENDENT_MIN_CHARS = 12
+
+
+def normalize_question(question: str) -> str:
+    """
+    表記ゆれを吸収するため、全角/半角の統一、小文字化、空白と記号の除去を行います。
+    """
+    text = unicodedata.normalize("NFKC", question).lower()
+    return "".join(ch for ch in text if unicodedata.category(ch)[0] not in ("P", "S", "Z", "C"))
+
+
+def is_cacheable_question(question: str, is_first_turn: bool) -> bool:
+    """
+    回答をキャッシュから返したり、キャッシュに保存したりしてよい質問かどうかを判定します。
+    最初の質問は常に対象とし、2回目以降は前の会話を参照していない十分な長さの質問だけを対象とします。
+    """
+    if is_first_turn:
+        return True
+    normalized = normalize_question(question)
+    if len(normalized) < CONTEXT_INDEPENDENT_MIN_CHARS:
+        return False
+    return not any(marker in normalized for marker in CONTEXT_DEPENDENT_MARKERS)
+
+
+def _bigrams(text: str) -> set[str]:
+    return {text[i:i + 2] for i in range(len(text) - 1)} or {text}
+
+
+def _similarity(a: str, b: str) -> float:
+    """
+    文字バイグラムのJaccard係数で、2つの正規化済みの質問の類似度を計算します。
+    """
+    a_grams, b_grams = _bigrams(a), _bigrams(b)
+    return len(a_grams & b_grams) / len(a_grams | b_grams)
+
+
+class ResponseCache:
+    """
+    SQLiteファイルに回答を保存するキャッシュです。
+
+    - TTL（ttl_seconds）を過ぎたエントリは使わずに削除します。
+    - エントリ数が max_entries、合計サイズが max_bytes を超えた場合は、最後に使われたのが古い順に削除します（LRU）。
+    - near_duplicate_threshold を指定すると、完全一致しない場合も類似度がしきい値以上の質問の回答を返します。
+    - hits / misses でヒット数とミス数を確認できます。
+    """
+
+    def __init__(
+        self,
+        path: str | None = None,
+        ttl_seconds: int | None = None,
+        max_entries: int | None = None,
+        max_bytes: int | None = None,
+        near_duplicate_threshold: float | None = None,
+    ):
+        self.path = path or os.getenv("RESPONSE_CACHE_PATH", DEFAULT_RESPONSE_CACHE_PATH)
+        self.ttl_seconds = ttl_seconds if ttl_seconds is not None else env_number("RESPONSE_CACHE_TTL_SECONDS", DEFAULT_RESPONSE_CACHE_TTL_SECONDS)
+        self.max_entries = max_entries if max_entries is not None else env_number("RESPONSE_CACHE_MAX_ENTRIES", DEFAULT_RESPONSE_CACHE_MAX_ENTRIES)
+        self.max_bytes = max_bytes if max_bytes is not None else env_number("RESPONSE_CACHE_MAX_BYTES", DEFAULT_RESPONSE_CACHE_MAX_BYTES)
+        self.near_duplicate_threshold = (
+            near_duplicate_threshold if near_duplicate_threshold is not None
+            else env_number("RESPONSE_CACHE_NEAR_DUPLICATE_THRESHOLD", 0.0, float)
+        )
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        # Streamlitの各セッションのスレッドから共有するため、1つの接続をロックで保護して使う
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL") # 複数プロセスからの同時読み込みに対応
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                scope TEXT NOT NULL,
+                question TEXT NOT NULL,
+                response TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_scope ON responses (scope, created_at)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed_at)")
+        self._conn.commit()
+
+    @staticmethod
+    def _scope(model_name: str, game_name: str, url: str) -> str:
+        return hashlib.sha256(f"{model_name}\n{game_name}\n{url}".encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _key(scope: str, normalized_question: str) -> str:
+        return hashlib.sha256(f"{scope}\n{normalized_question}".encode("utf-8")).hexdigest()
+
+    def _find_near_duplicate(self, scope: str, normalized_question: str, min_created_at: float) -> tuple[str, str] | None:
+        rows = self._conn.execute(
+            "SELECT key, question, response FROM responses WHERE scope = ? AND created_at >= ? ORDER BY created_at DESC LIMIT ?",
+            (scope, min_created_at, NEAR_DUPLICATE_SCAN_LIMIT),
+        ).fetchall()
+        best = None
+        best_score = self.near_duplicate_threshold
+        for key, question, response in rows:
+            score = _similarity(normalized_question, question)
+            if score >= best_score:
+                best, best_score = (key, response), score
+        return best
+
+    def get(self, model_name: str, game_name: str, url: str, question: str) -> str | None:
+        """
+        キャッシュされた回答を返します。見つからない場合は None を返します。
+        """
+        scope = self._scope(model_name, game_name, url)
+        normalized = normalize_question(question)
+        now = time.time()
+        min_created_at = now - self.ttl_seconds
+
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT key, response FROM responses WHERE key = ? AND created_at >= ?",
+                (self._key(scope, normalized), min_created_at),
+            ).fetchone()
+            if row is None and self.near_duplicate_threshold > 0:
+                row = self._find_near_duplicate(scope, normalized, min_created_at)
+            if row is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self._conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, row[0]))
+            self._conn.commit()
+            return row[1]
+
+    def put(self, model_name: str, game_name: str, url: str, question: str, response: str) -> None:
+        """
+        回答をキャッシュに保存し、上限を超えた分のエントリを削除します。
+        """
+        scope = self._scope(model_name, game_name, url)
+        normalized = normalize_question(question)
+        now = time.time()
+
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, scope, question, response, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (self._key(scope, normalized), scope, normalized, response, len(response.encode("utf-8")), now, now),
+            )
+            self._evict(now)
+            self._conn.commit()
+
+    def _evict(self, now: float) -> None:
+        self._conn.execute("DELETE FROM responses WHERE created_at < ?", (now - self.ttl_seconds,))
+
+        count = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        if count > self.max_entries:
+            self._conn.execute(
+                "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY accessed_at LIMIT ?)",
+                (count - self.max_entries,),
+            )
+        total_bytes = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        while total_bytes > self.max_bytes:
+            # 合計サイズが上限を下回るまで、最後に使われたのが古いエントリから削除する
+            oldest = self._conn.execute("SELECT key, size FROM responses ORDER BY accessed_at LIMIT 1").fetchone()
+            if oldest is None:
+                break
+            self._conn.execute("DELETE FROM responses WHERE key = ?", (oldest[0],))
+            total_bytes -= oldest[1]
+
+    def stats(self) -> dict:
+        """
+        ヒット数、ミス数、ヒット率、保存されているエントリ数を返します。
+        """
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": entries,
+        }
@@ -0,0 +1,305 @@
+"""
+スクレイピングした攻略ページの本文から、質問に関連する部分だけを取り出すための検索インデックスです。
+本文をチャンクに分割し、BM25 の転置インデックスをゲームごとにディスクへ保存します。
+ページ全体をプロンプトに入れる代わりに、関連度の高い上位のチャンクだけをGeminiに渡します。
+"""
+import hashlib
+import json
+import math
+import os
+import re
+import tempfile
+import threading
+import time
+import unicodedata
+from collections import Counter
+from collections.abc import Callable
+
+from config import env_number
+from crawler import crawl_site, normalize_url
+from page_cache import DEFAULT_PAGE_CACHE_TTL_SECONDS
+
+DEFAULT_RETRIEVAL_INDEX_DIR = ".cache/index"
+
+# チャンクの文字数と、前後のチャンクと重ねる文字数
+CHUNK_SIZE = 400
+CHUNK_OVERLAP = 80
+
+# BM25 のパラメータ
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+# 埋め込みで再順位付けする際に、BM25 の上位から候補として取り出す件数の倍率
+EMBEDDING_CANDIDATE_FACTOR = 5
+
+# 英数字の単語、または日本語（ひらがな・カタカナ・漢字）の連続部分にマッチする
+_TOKEN_PATTERN = re.compile(r"[a-z0-9]+|[\u3040-\u30ff\u3400-\u9fff\uf900-\ufaff]+")
+
+
+def tokenize(text: str) -> list[str]:
+    """
+    検索用にテキストをトークンに分割します。
+    英数字は単語単位、日本語は分かち書きが不要な文字バイグラム（2文字ずつ）に分割します。
+    """
+    tokens = []
+    for match in _TOKEN_PATTERN.finditer(unicodedata.normalize("NFKC", text).lower()):
+        token = match.group()
+        if token.isascii() or len(token) == 1:
+            tokens.append(token)
+        else:
+            tokens.extend(token[i:i + 2] for i in range(len(token) - 1))
+    return tokens
+
+
+def chunk_text(text: str, size: int = CHUNK_SIZE, overlap: int = CHUNK_OVERLAP) -> list[str]:
+    """
+    本文を size 文字ごとのチャンクに分割します。
+    チャンクの境界で文脈が途切れないよう、前のチャンクと overlap 文字だけ重ねます。
+    """
+    text = text.strip()
+    if not text:
+        return []
+    step = size - overlap
+    return [text[start:start + size] for start in range(0, max(len(text) - overlap, 1), step)]
+
+
+def _cosine(a: list[float], b: list[float]) -> float:
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norm if norm else 0.0
+
+
+class RetrievalIndex:
+    """
+    ゲームごとの BM25 検索インデックスです。
+
+    - chunks: チャンクID → {'url', 'title', 'text'}
+    - postings: トークン → {チャンクID: 出現回数} （転置インデックス）
+    - url_chunks: URL → そのページのチャンクIDのリスト （ページ単位での差し替え用）
+    - url_indexed_at: URL → そのページをインデックスに追加（または内容を確認）した時刻 （再巡回の判定用）
+
+    embed_fn（テキストのリストを受け取り、埋め込みベクトルのリストを返す関数）が渡された場合は、
+    BM25 の上位候補を埋め込みのコサイン類似度も加味して並べ替えます。
+    """
+
+    def __init__(self, game_name: str, index_dir: str | None = None, embed_fn: Callable[[list[str]], list[list[float]] | None] | None = None):
+        self.game_name = game_name
+        self.index_dir = index_dir or os.getenv("RETRIEVAL_INDEX_DIR", DEFAULT_RETRIEVAL_INDEX_DIR)
+        self.embed_fn = embed_fn
+        self.chunks: dict[int, dict] = {}
+        self.postings: dict[str, dict[int, int]] = {}
+        self.doc_lengths: dict[int, int] = {}
+        self.url_chunks: dict[str, list[int]] = {}
+        self.url_indexed_at: dict[str, float] = {}
+        self.embeddings: dict[int, list[float]] = {}
+        self.next_id = 0
+        self.total_length = 0
+        self._lock = threading.RLock()
+        self._load()
+
+    @property
+    def path(self) -> str:
+        name = hashlib.sha256(self.game_name.encode("utf-8")).hexdigest()[:32]
+        return os.path.join(self.index_dir, f"{name}.json")
+
+    def _load(self) -> None:
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            print(f"検索インデックスの読み込み中にエラーが発生しました ({self.game_name}): {e}")
+            return
+        # JSONのキーは文字列になるため、チャンクIDを整数に戻す
+        self.chunks = {int(chunk_id): chunk for chunk_id, chunk in data["chunks"].items()}
+        self.postings = {
+            token: {int(chunk_id): tf for chunk_id, tf in posting.items()}
+            for token, posting in data["postings"].items()
+        }
+        self.doc_lengths = {int(chunk_id): length for chunk_id, length in data["doc_lengths"].items()}
+        self.url_chunks = data["url_chunks"]
+        # 追加した時刻を保存していない古いインデックスは、次の巡回で内容を確認する
+        self.url_indexed_at = data.get("url_indexed_at", {})
+        self.embeddings = {int(chunk_id): vector for chunk_id, vector in data.get("embeddings", {}).items()}
+        self.next_id = data["next_id"]
+        self.total_length = sum(self.doc_lengths.values())
+
+    def save(self) -> None:
+        """
+        インデックスをディスクに保存します。書き込み途中のファイルが読まれないよう、一時ファイル経由で置き換えます。
+        """
+        with self._lock:
+            data = {
+                "game_name": self.game_name,
+                "next_id": self.next_id,
+                "chunks": self.chunks,
+                "postings": self.postings,
+                "doc_lengths": self.doc_lengths,
+                "url_chunks": self.url_chunks,
+                "url_indexed_at": self.url_indexed_at,
+                "embeddings": self.embeddings,
+            }
+            os.makedirs(self.index_dir, exist_ok=True)
+            tmp_path = None
+            try:
+                # 同じゲームのインデックスを別のスレッドやプロセスが同時に保存しても衝突しないよう、一時ファイル名は毎回作る
+                fd, tmp_path = tempfile.mkstemp(dir=self.index_dir, suffix=".tmp")
+                with os.fdopen(fd, "w", encoding="utf-8") as f:
+                    json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+                os.replace(tmp_path, self.path)
+            except OSError as e:
+                print(f"検索インデックスの保存中にエラーが発生しました ({self.game_name}): {e}")
+                if tmp_path and os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+
+    def has_url(self, url: str) -> bool:
+        with self._lock:
+            return url in self.url_chunks
+
+    def indexed_at(self, url: str) -> float | None:
+        """
+        URLのページをインデックスに追加した（または内容を確認した）時刻を返します。未登録の場合は None を返します。
+        """
+        with self._lock:
+            if url not in self.url_chunks:
+                return None
+            return self.url_indexed_at.get(url, 0.0)
+
+    def remove_url(self, url: str) -> None:
+        """
+        指定したURLのチャンクをインデックスから取り除きます。
+        """
+        with self._lock:
+            self.url_indexed_at.pop(url, None)
+            for chunk_id in self.url_chunks.pop(url, []):
+                chunk = self.chunks.pop(chunk_id)
+                self.embeddings.pop(chunk_id, None)
+                self.total_length -= self.doc_lengths.pop(chunk_id)
+                # チャンクに含まれるトークンの転置リストだけを更新する
+                for token in set(tokenize(chunk["text"])):
+                    posting = self.postings.get(token)
+                    if posting is not None:
+                        posting.pop(chunk_id, None)
+                        if not posting:
+                            del self.postings[token]
+
+    def add_page(self, url: str, parsed: dict) -> int:
+        """
+        parse_html_content の結果をチャンクに分割してインデックスに追加し、追加したチャンク数を返します。
+        同じURLがすでに登録されている場合は、古いチャンクを置き換えます。
+        内容が変わっていない場合は、チャンク（と埋め込み）を作り直さず、追加した時刻だけを更新して 0 を返します。
+        """
+        texts = chunk_text(parsed["body_text"])
+        with self._lock:
+            if url in self.url_chunks and [self.chunks[chunk_id]["text"] for chunk_id in self.url_chunks[url]] == texts:
+                self.url_indexed_at[url] = time.time()
+                return 0
+        vectors = self.embed_fn(texts) if self.embed_fn and texts else None
+
+        with self._lock:
+            if url in self.url_chunks:
+                self.remove_url(url)
+            chunk_ids = []
+            for i, text in enumerate(texts):
+                chunk_id = self.next_id
+                self.next_id += 1
+                tokens = tokenize(text)
+                self.chunks[chunk_id] = {"url": url, "title": parsed["title"], "text": text}
+                self.doc_lengths[chunk_id] = len(tokens)
+                self.total_length += len(tokens)
+                for token, tf in Counter(tokens).items():
+                    self.postings.setdefault(token, {})[chunk_id] = tf
+                if vectors:
+                    self.embeddings[chunk_id] = vectors[i]
+                chunk_ids.append(chunk_id)
+            self.url_chunks[url] = chunk_ids
+            self.url_indexed_at[url] = time.time()
+        return len(texts)
+
+    def _bm25_scores(self, query_tokens: list[str], url_prefix: str) -> dict[int, float]:
+        doc_count = len(self.chunks)
+        average_length = (self.total_length / doc_count if doc_count else 0) or 1
+        scores: dict[int, float] = {}
+        for token in set(query_tokens):
+            posting = self.postings.get(token)
+            if not posting:
+                continue
+            idf = math.log(1 + (doc_count - len(posting) + 0.5) / (len(posting) + 0.5))
+            for chunk_id, tf in posting.items():
+                if url_prefix and not self.chunks[chunk_id]["url"].startswith(url_prefix):
+                    continue
+                length_norm = 1 - BM25_B + BM25_B * self.doc_lengths[chunk_id] / average_length
+                scores[chunk_id] = scores.get(chunk_id, 0.0) + idf * tf * (BM25_K1 + 1) / (tf + BM25_K1 * length_norm)
+        return scores
+
+    def search(self, query: str, top_k: int = 4, url_prefix: str = "") -> list[dict]:
+        """
+        質問に関連するチャンクを関連度の高い順に最大 top_k 件返します。
+        url_prefix を指定した場合は、そのURLで始まるページのチャンクだけを対象にします。
+        戻り値: [{'url', 'title', 'text', 'score'}, ...]
+        """
+        with self._lock:
+            scores = self._bm25_scores(tokenize(query), url_prefix)
+            ranked = sorted(scores, key=scores.get, reverse=True)
+            # 埋め込みの取得 (API呼び出し) の間に他のスレッドがインデックスを更新してもよいよう、候補の内容はここで取り出しておく
+            candidate_count = top_k * EMBEDDING_CANDIDATE_FACTOR if self.embed_fn and self.embeddings else top_k
+            results = {chunk_id: dict(self.chunks[chunk_id], score=scores[chunk_id]) for chunk_id in ranked[:candidate_count]}
+            candidate_vectors = {chunk_id: self.embeddings[chunk_id] for chunk_id in results if chunk_id in self.embeddings}
+
+        if self.embed_fn and candidate_vectors:
+            # BM25 の上位候補だけを、埋め込みの類似度も加味して並べ替える (ロックを持たずに埋め込みを取得する)
+            query_vectors = self.embed_fn([query])
+            if query_vectors:
+                max_score = scores[ranked[0]]
+                for chunk_id, vector in candidate_vectors.items():
+                    results[chunk_id]["score"] = scores[chunk_id] / max_score + _cosine(query_vectors[0], vector)
+                ranked = sorted(candidate_vectors, key=lambda chunk_id: results[chunk_id]["score"], reverse=True)
+
+        return [results[chunk_id] for chunk_id in ranked[:top_k]]
+
+
+def format_reference_chunks(chunks: list[dict]) -> str:
+    """
+    検索結果のチャンクを、プロンプトに含めるための参照情報のテキストに整形します。
+    """
+    return "\n\n".join(f"[{i}] {chunk['title']} ({chunk['url']})\n{chunk['text']}" for i, chunk in enumerate(chunks, 1))
+
+
+def index_site(
+    index: RetrievalIndex,
+    seed_url: str,
+    page_cache=None,
+    max_depth: int | None = None,
+    max_pages: int | None = None,
+    refresh_seconds: int | None = None,
+) -> int:
+    """
+    seed_url から攻略サイトを巡回し、取得したページをインデックスに追加して保存します。追加・更新したページ数を返します。
+    seed_url を refresh_seconds 以内にインデックスに追加している場合は巡回しません。
+    それより古い場合は、ページキャッシュ経由で巡回し直し (更新されていないページは ETag / Last-Modified の再検証だけで済む)、
+    内容が変わったページのチャンクだけを置き換えます。
+    refresh_seconds を省略した場合は、page_cache の TTL（未指定の場合は環境変数 PAGE_CACHE_TTL_SECONDS）を使います。
+    巡回の深さとページ数は、環境変数 CRAWL_MAX_DEPTH / CRAWL_MAX_PAGES で設定できます。
+    """
+    seed_url = normalize_url(seed_url)
+    if seed_url is None:
+        return 0
+    if refresh_seconds is None:
+        refresh_seconds = page_cache.ttl_seconds if page_cache is not None else env_number("PAGE_CACHE_TTL_SECONDS", DEFAULT_PAGE_CACHE_TTL_SECONDS)
+    indexed_at = index.indexed_at(seed_url)
+    if indexed_at is not None and time.time() - indexed_at < refresh_seconds:
+        return 0
+    max_depth = max_depth if max_depth is not None else env_number("CRAWL_MAX_DEPTH", 1)
+    max_pages = max_pages if max_pages is not None else env_number("CRAWL_MAX_PAGES", 10)
+
+    page_count = 0
+    fetched = False
+    for page in crawl_site(seed_url, max_depth=max_depth, max_pages=max_pages, page_cache=page_cache):
+        fetched = True
+        if index.add_page(page["url"], page["parsed"]):
+            page_count += 1
+    if fetched:
+        # 内容が変わっていないページも、確認した時刻を保存する
+        index.save()
+    return page_count
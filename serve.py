@@ -0,0 +1,80 @@
+"""
+Streamlitサーバーの起動スクリプトです。
+
+サーバーを起動する前に、同じプロセス内でGeminiモデルや共有クライアント、各種キャッシュを準備します（事前ウォームアップ）。
+Streamlitのヘルスチェック (/_stcore/health) はサーバーの起動後にしか応答しないため、
+ヘルスチェックが通った時点で app_resources.py の @st.cache_resource はすでに作成済みになり、
+オートスケールで起動したコンテナでも、最初のユーザーが初期化の待ち時間を負担することはありません。
+
+    python serve.py [--port 8501] [--address 0.0.0.0] [--skip-prewarm]
+"""
+import argparse
+import os
+import threading
+import time
+
+from config import env_number
+
+# スクリプトとして実行された場合も、Streamlitが読み込むアプリと同じ作業ディレクトリ・モジュールを使う
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_SCRIPT = os.path.join(APP_DIR, "streamlit_app.py")
+
+
+def refresh_model_list_in_background(api_key: str) -> None:
+    """
+    保存済みのモデルのリストがない、または有効期限切れの場合は、バックグラウンドで取得し直します。
+    起動処理はこの取得を待ちません（モデル名の確認は保存済みのリストがある場合のみ行われます）。
+    """
+    from gemini_assistant import list_available_models, load_model_list_cache
+
+    if load_model_list_cache() is None:
+        threading.Thread(target=list_available_models, args=(api_key,), name="model-list-refresh", daemon=True).start()
+
+
+def prewarm() -> None:
+    """
+    重いモジュールの読み込み、Geminiモデルと共有クライアントの初期化、各種キャッシュの作成を行います。
+    """
+    start = time.perf_counter()
+    # アプリが使うモジュールを先に読み込んでおく (google.generativeai はモデルの初期化時に読み込まれる)
+    from app_resources import get_gemini_model, get_page_cache, get_response_cache, get_session_store
+    from gemini_client import get_client
+
+    api_key = os.getenv("GEMINI_API_KEY")
+    if not api_key:
+        print("GEMINI_API_KEY が設定されていないため、Geminiモデルの事前準備を省略します。")
+    elif get_gemini_model(api_key) is None:
+        print("Geminiモデルの事前準備に失敗しました。アプリの画面でエラーが表示されます。")
+    else:
+        refresh_model_list_in_background(api_key)
+        # 質問の振り分けで使う軽量なモデルも準備しておく
+        fast_model_name = os.getenv("GEMINI_FAST_MODEL_NAME")
+        if fast_model_name and get_gemini_model(api_key, fast_model_name) is None:
+            print(f"軽量なモデル '{fast_model_name}' の事前準備に失敗しました。通常のモデルで回答します。")
+    get_client()
+    get_page_cache()
+    get_response_cache()
+    get_session_store()
+    print(f"事前ウォームアップが完了しました ({time.perf_counter() - start:.2f}秒)")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="事前ウォームアップを行ってからStreamlitサーバーを起動します")
+    parser.add_argument("--port", type=int, default=env_number("PORT", 8501))
+    parser.add_argument("--address", default="0.0.0.0")
+    parser.add_argument("--skip-prewarm", action="store_true", help="事前ウォームアップを行わずに起動する")
+    args = parser.parse_args()
+
+    os.chdir(APP_DIR)
+    if not args.skip_prewarm:
+        prewarm()
+
+    from streamlit.web import bootstrap
+
+    flag_options = {"server.port": args.port, "server.address": args.address}
+    bootstrap.load_config_options(flag_options=flag_options)
+    bootstrap.run(APP_SCRIPT, False, [], flag_options)
+
+
+if __name__ == "__main__":
+    main()
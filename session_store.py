@@ -0,0 +1,265 @@
+"""
+チャットのセッション（ゲーム名、参照URL、会話履歴、会話の要約）を保存するモジュールです。
+Streamlitの st.session_state はプロセスのメモリ上にしかないため、サーバーの再起動や別のレプリカへの移動で失われます。
+セッションをストアに保存しておけば、URLのセッションID（?session=...）から同じ会話を再開できます。
+
+- メッセージは追記のみで保存し、1件ずつ「ロールを表す1バイト + 本文」の形式で保持します（長い本文はzlibで圧縮）。
+- 再開時は直近のメッセージだけを読み込み、それより古いメッセージは必要になったときに読み込みます。
+- 保存先は環境変数 SESSION_STORE_URL で指定します。
+  - sqlite:///<ファイルのパス> (デフォルト: sqlite:///.cache/sessions.sqlite3)
+  - redis://<ホスト>:<ポート>/<DB番号> (Redis互換のサーバー。redis パッケージが必要)
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+import zlib
+
+from config import env_number
+from conversation_history import ConversationHistory
+
+DEFAULT_SESSION_STORE_URL = "sqlite:///.cache/sessions.sqlite3"
+DEFAULT_SESSION_TTL_SECONDS = 30 * 24 * 60 * 60
+
+# メモリに残す直近のメッセージ数（これより古いメッセージはストアから読み直す）
+DEFAULT_SESSION_MAX_IN_MEMORY_MESSAGES = 40
+
+# この大きさ以上の本文はzlibで圧縮して保存する
+COMPRESS_MIN_BYTES = 512
+
+# ロールを1バイトで表す（大文字の場合は本文が圧縮されている）
+ROLE_CODES = {"user": b"u", "assistant": b"a"}
+ROLES_BY_CODE = {code: role for role, code in ROLE_CODES.items()}
+
+
+def get_max_in_memory_messages() -> int:
+    """
+    環境変数 SESSION_MAX_IN_MEMORY_MESSAGES から、メモリに残す直近のメッセージ数を読み込みます。
+    """
+    return max(env_number("SESSION_MAX_IN_MEMORY_MESSAGES", DEFAULT_SESSION_MAX_IN_MEMORY_MESSAGES), 2)
+
+
+def encode_message(role: str, content: str) -> bytes:
+    data = content.encode("utf-8")
+    if len(data) >= COMPRESS_MIN_BYTES:
+        return ROLE_CODES[role].upper() + zlib.compress(data)
+    return ROLE_CODES[role] + data
+
+
+def decode_message(data: bytes) -> dict:
+    code, body = data[:1], data[1:]
+    if code.isupper():
+        body = zlib.decompress(body)
+    return {"role": ROLES_BY_CODE[code.lower()], "content": body.decode("utf-8")}
+
+
+class SqliteSessionStore:
+    """
+    SQLiteファイルにセッションを保存するストアです（デフォルト）。
+    最後の更新から ttl_seconds を過ぎたセッションは、新しいセッションの作成時に削除します。
+    """
+
+    def __init__(self, path: str, ttl_seconds: int):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        # Streamlitの各セッションのスレッドから共有するため、1つの接続をロックで保護して使う
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL") # 複数プロセス（レプリカ）からの同時アクセスに対応
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS sessions (
+                id TEXT PRIMARY KEY,
+                state TEXT NOT NULL,
+                message_count INTEGER NOT NULL,
+                updated_at REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS messages (
+                session_id TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                data BLOB NOT NULL,
+                PRIMARY KEY (session_id, seq)
+            ) WITHOUT ROWID
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS sessions_updated ON sessions (updated_at)")
+        self._conn.commit()
+
+    def create(self, state: dict) -> str:
+        session_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            self._evict(now)
+            self._conn.execute(
+                "INSERT INTO sessions (id, state, message_count, updated_at) VALUES (?, ?, 0, ?)",
+                (session_id, json.dumps(state, ensure_ascii=False), now),
+            )
+            self._conn.commit()
+        return session_id
+
+    def load_state(self, session_id: str) -> dict | None:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT state, message_count FROM sessions WHERE id = ? AND updated_at >= ?",
+                (session_id, time.time() - self.ttl_seconds),
+            ).fetchone()
+        if row is None:
+            return None
+        return {**json.loads(row[0]), "message_count": row[1]}
+
+    def update_state(self, session_id: str, **fields) -> None:
+        with self._lock:
+            row = self._conn.execute("SELECT state FROM sessions WHERE id = ?", (session_id,)).fetchone()
+            if row is None:
+                return
+            state = {**json.loads(row[0]), **fields}
+            self._conn.execute(
+                "UPDATE sessions SET state = ?, updated_at = ? WHERE id = ?",
+                (json.dumps(state, ensure_ascii=False), time.time(), session_id),
+            )
+            self._conn.commit()
+
+    def append_message(self, session_id: str, role: str, content: str) -> None:
+        with self._lock:
+            # 連番の採番と追記を1つのトランザクションで行う（同じセッションを複数のタブで開いている場合に備える）
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute("SELECT message_count FROM sessions WHERE id = ?", (session_id,)).fetchone()
+                if row is None:
+                    self._conn.rollback()
+                    return
+                self._conn.execute(
+                    "INSERT INTO messages (session_id, seq, data) VALUES (?, ?, ?)",
+                    (session_id, row[0], encode_message(role, content)),
+                )
+                self._conn.execute(
+                    "UPDATE sessions SET message_count = ?, updated_at = ? WHERE id = ?",
+                    (row[0] + 1, time.time(), session_id),
+                )
+                self._conn.commit()
+            except Exception:
+                self._conn.rollback()
+                raise
+
+    def load_messages(self, session_id: str, start: int, end: int | None = None) -> list[dict]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT data FROM messages WHERE session_id = ? AND seq >= ? AND seq < ? ORDER BY seq",
+                (session_id, start, end if end is not None else 2 ** 62),
+            ).fetchall()
+        return [decode_message(row[0]) for row in rows]
+
+    def _evict(self, now: float) -> None:
+        expired = "SELECT id FROM sessions WHERE updated_at < ?"
+        self._conn.execute(f"DELETE FROM messages WHERE session_id IN ({expired})", (now - self.ttl_seconds,))
+        self._conn.execute("DELETE FROM sessions WHERE updated_at < ?", (now - self.ttl_seconds,))
+
+
+class RedisSessionStore:
+    """
+    Redis互換のサーバーにセッションを保存するストアです（複数のレプリカで共有する場合向け）。
+    セッションの状態はハッシュ、メッセージはリストに保存し、どちらも最後の更新から ttl_seconds で期限切れにします。
+    """
+
+    def __init__(self, url: str, ttl_seconds: int):
+        import redis  # 任意の依存関係のため、Redisを使う場合にだけ読み込む
+
+        self.ttl_seconds = ttl_seconds
+        self._redis = redis.Redis.from_url(url)
+
+    @staticmethod
+    def _keys(session_id: str) -> tuple[str, str]:
+        return f"session:{session_id}", f"session:{session_id}:messages"
+
+    def _touch(self, pipe, session_id: str) -> None:
+        for key in self._keys(session_id):
+            pipe.expire(key, self.ttl_seconds)
+
+    def create(self, state: dict) -> str:
+        session_id = uuid.uuid4().hex
+        state_key, _ = self._keys(session_id)
+        with self._redis.pipeline() as pipe:
+            pipe.hset(state_key, "state", json.dumps(state, ensure_ascii=False))
+            pipe.expire(state_key, self.ttl_seconds)
+            pipe.execute()
+        return session_id
+
+    def load_state(self, session_id: str) -> dict | None:
+        state_key, messages_key = self._keys(session_id)
+        with self._redis.pipeline() as pipe:
+            pipe.hget(state_key, "state")
+            pipe.llen(messages_key)
+            state, message_count = pipe.execute()
+        if state is None:
+            return None
+        return {**json.loads(state), "message_count": message_count}
+
+    def update_state(self, session_id: str, **fields) -> None:
+        state = self.load_state(session_id)
+        if state is None:
+            return
+        state.pop("message_count")
+        with self._redis.pipeline() as pipe:
+            pipe.hset(self._keys(session_id)[0], "state", json.dumps({**state, **fields}, ensure_ascii=False))
+            self._touch(pipe, session_id)
+            pipe.execute()
+
+    def append_message(self, session_id: str, role: str, content: str) -> None:
+        with self._redis.pipeline() as pipe:
+            pipe.rpush(self._keys(session_id)[1], encode_message(role, content))
+            self._touch(pipe, session_id)
+            pipe.execute()
+
+    def load_messages(self, session_id: str, start: int, end: int | None = None) -> list[dict]:
+        if end is not None and end <= start:
+            return []
+        stop = end - 1 if end is not None else -1 # LRANGE の終了位置は末尾を含む
+        return [decode_message(data) for data in self._redis.lrange(self._keys(session_id)[1], start, stop)]
+
+
+def open_session_store(url: str | None = None, ttl_seconds: int | None = None):
+    """
+    SESSION_STORE_URL（または url）に応じたセッションストアを作成します。
+    Redisを指定していても redis パッケージがインストールされていない場合は、SQLiteのストアを使います。
+    """
+    url = url or os.getenv("SESSION_STORE_URL", DEFAULT_SESSION_STORE_URL)
+    ttl_seconds = ttl_seconds if ttl_seconds is not None else env_number("SESSION_TTL_SECONDS", DEFAULT_SESSION_TTL_SECONDS)
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        try:
+            return RedisSessionStore(url, ttl_seconds)
+        except ImportError:
+            print("redis パッケージがインストールされていないため、SQLiteのセッションストアを使用します。")
+            url = DEFAULT_SESSION_STORE_URL
+    if not url.startswith("sqlite:///"):
+        print(f"SESSION_STORE_URL の値 '{url}' に対応していないため、デフォルト値 {DEFAULT_SESSION_STORE_URL} を使用します。")
+        url = DEFAULT_SESSION_STORE_URL
+    return SqliteSessionStore(url[len("sqlite:///"):], ttl_seconds)
+
+
+def load_history(store, session_id: str, state: dict, max_messages: int) -> ConversationHistory:
+    """
+    保存済みのセッションから会話履歴を復元します。
+    読み込むのは、直近 max_messages 件と、まだ要約されていないやり取り（summarized_upto 以降）だけです。
+    """
+    message_count = state["message_count"]
+    first_user_index = state.get("first_user_index")
+    start = max(message_count - max_messages, 0)
+    first_user_message = ""
+    if first_user_index is not None:
+        # ContextWindow がそのまま送信する、要約されていないやり取りは必ず読み込む
+        start = min(start, first_user_index + state.get("summarized_upto", 1))
+        if first_user_index < start:
+            first_user_message = store.load_messages(session_id, first_user_index, first_user_index + 1)[0]["content"]
+    messages = store.load_messages(session_id, start)
+    return ConversationHistory.restore(
+        state["game_name"], state["url"], messages, start, first_user_index, first_user_message
+    )
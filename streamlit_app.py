@@ -1,8 +1,17 @@
 import streamlit as st
 import os
-# web_scraper.py は現在使用しませんが、ファイルはプロジェクト内に存在します。
-# したがって、ここではインポートしません。
-from gemini_assistant import initialize_gemini_model, ask_gemini
+from urllib.parse import urlparse
+from gemini_assistant import StreamInterruptedError, ask_gemini_stream
+from conversation_history import ConversationHistory, with_reference
+from context_window import ContextWindow, make_gemini_summarizer
+from crawler import normalize_url
+from retrieval_index import format_reference_chunks, index_site
+from response_cache import is_cacheable_question
+from instrumentation import record, span, start_trace
+from query_router import get_fast_model_name, route_question
+from session_store import get_max_in_memory_messages, load_history
+# Geminiモデルやキャッシュなど、全セッションで共有するリソース (serve.py による起動時の事前準備の対象)
+from app_resources import get_gemini_model, get_page_cache, get_response_cache, get_retrieval_index, get_session_store
 
 # ページ設定
 st.set_page_config(
@@ -20,33 +29,95 @@ gemini_api_key = os.getenv("GEMINI_API_KEY")
 
 # セッション状態の初期化
 # Streamlitアプリが再実行されても状態を保持するために使用します。
-if "messages" not in st.session_state:
-    st.session_state.messages = [] # 会話履歴を格納
+if "history" not in st.session_state:
+    st.session_state.history = ConversationHistory() # 会話履歴（UI表示用とGemini API用）を格納
 if "game_name" not in st.session_state:
     st.session_state.game_name = "" # 現在のゲーム名
 if "url" not in st.session_state:
     st.session_state.url = "" # 参照URL
-    
-# Geminiモデルの初期化 (パフォーマンスのためにキャッシュ)
-# @st.cache_resource デコレータは、関数が同じ引数で呼び出された場合、
-# その結果をキャッシュし、アプリの再実行時に再計算しないようにします。
-@st.cache_resource
-def get_gemini_model(_api_key):
+if "session_id" not in st.session_state:
+    st.session_state.session_id = None # セッションストアでのセッションID (URLの ?session= と同じ値)
+if "last_trace" not in st.session_state:
+    st.session_state.last_trace = None # 直近の処理の計測結果 (デバッグ表示用)
+
+# 回答のストリーミングが途中で失敗した場合に、途中までの回答の末尾に付ける注記
+INTERRUPTED_NOTICE = "⚠️ *回答の生成が途中で中断されました。もう一度質問してください。*"
+
+def render_stream(placeholder, stream) -> tuple[str, bool]:
     """
-    Geminiモデルを初期化し、キャッシュします。
+    ストリーミングで届くテキストを、届いた分だけプレースホルダーに逐次描画します。
+    最初のチャンクが届くまではスピナーを表示し、(最終的な全文, 最後まで届いたか) を返します（取得失敗時は空文字）。
+    途中で中断された場合は、届いた部分に中断された旨を付けて表示し、その表示内容を返します。
     """
-    if not _api_key:
-        return None
+    with st.spinner("考え中..."):
+        first_chunk = next(stream, None)
+    if first_chunk is None:
+        return "", False
+
+    parts = [first_chunk]
+    placeholder.markdown(first_chunk + "▌") # 生成中であることを示すカーソルを末尾に表示
     try:
-        model = initialize_gemini_model(_api_key)
-        return model
-    except Exception as e:
-        # モデル初期化のエラーをStreamlit UIに表示
-        st.error(f"Geminiモデルの初期化中にエラーが発生しました。APIキーが正しいか、またはモデル名が利用可能か確認してください: {e}")
-        return None
+        for chunk in stream:
+            parts.append(chunk)
+            placeholder.markdown("".join(parts) + "▌")
+    except StreamInterruptedError:
+        # 途中までの回答を完全な回答として扱わないよう、中断されたことを明示する
+        interrupted_text = "".join(parts) + f"\n\n{INTERRUPTED_NOTICE}"
+        placeholder.markdown(interrupted_text)
+        return interrupted_text, False
+    full_text = "".join(parts)
+    placeholder.markdown(full_text) # 生成完了後はカーソルを外して確定表示
+    return full_text, True
+
+def append_message(role: str, content: str) -> None:
+    """
+    会話履歴にメッセージを追加し、セッションストアにも追記します。
+    """
+    history = st.session_state.history
+    history.append(role, content)
+    if not st.session_state.session_id:
+        return
+    store = get_session_store()
+    store.append_message(st.session_state.session_id, role, content)
+    if history.first_user_index == history.message_count - 1:
+        # 再開時に指示文付きの最初の質問を復元できるよう、その位置を保存する
+        store.update_state(st.session_state.session_id, first_user_index=history.first_user_index)
+
+def resume_session(session_id: str, model) -> bool:
+    """
+    セッションストアから保存済みのセッションを読み込みます。直近のメッセージだけをメモリに読み込み、
+    要約済みの古いやり取りは読み込みません。セッションが見つからない場合は False を返します。
+    """
+    store = get_session_store()
+    state = store.load_state(session_id)
+    if state is None:
+        return False
+    st.session_state.session_id = session_id
+    st.session_state.game_name = state["game_name"]
+    st.session_state.url = state["url"]
+    st.session_state.history = load_history(store, session_id, state, get_max_in_memory_messages())
+    st.session_state.context_window = ContextWindow(
+        make_gemini_summarizer(model), summary=state.get("summary", ""), summarized_upto=state.get("summarized_upto", 1)
+    )
+    return True
+
+def search_reference(question: str) -> list[dict]:
+    """
+    参照URLのサイトから、質問に関連するチャンクを検索します。
+    """
+    if not st.session_state.url:
+        return []
+    # 同じゲームの別のサイトの情報が混ざらないよう、参照URLと同じサイトのチャンクに限定する
+    parsed_url = urlparse(st.session_state.url)
+    return get_retrieval_index(st.session_state.game_name).search(
+        question, top_k=4, url_prefix=f"{parsed_url.scheme}://{parsed_url.netloc}"
+    )
 
 # モデルの初期化を試みる
 gemini_model = get_gemini_model(gemini_api_key)
+# 短い追加の質問に使う軽量なモデル (GEMINI_FAST_MODEL_NAME が設定されている場合のみ。モデルごとに別にキャッシュされる)
+fast_model_name = get_fast_model_name()
+fast_model = get_gemini_model(gemini_api_key, fast_model_name) if gemini_api_key and fast_model_name else None
 
 # APIキーの存在チェック
 if not gemini_api_key:
@@ -60,13 +131,32 @@ if gemini_model is None:
     st.error("Geminiモデルの初期化に失敗しました。APIキーが正しいか確認してください。")
     st.stop() # モデル初期化に失敗した場合はアプリの実行を停止
 
+# URLのセッションID (?session=...) から、保存済みのセッションを再開する
+# (サーバーの再起動や別のレプリカへの移動で st.session_state が失われても、同じ会話を続けられる)
+requested_session_id = st.query_params.get("session")
+if requested_session_id and requested_session_id != st.session_state.session_id:
+    if not resume_session(requested_session_id, gemini_model):
+        st.warning("指定されたセッションが見つからないか、有効期限が切れています。新しいセッションを開始してください。")
+        st.query_params.pop("session", None)
+
+# 会話履歴をトークン予算内に収めるためのコンテキストウィンドウ（要約はセッションごとにキャッシュ）
+if "context_window" not in st.session_state:
+    st.session_state.context_window = ContextWindow(make_gemini_summarizer(gemini_model))
+
 # セッションリセットボタン (サイドバーに配置)
 if st.sidebar.button("セッションをリセットして最初から始める"):
-    st.session_state.messages = [] # 会話履歴をクリア
+    st.session_state.history = ConversationHistory() # 会話履歴をクリア
+    del st.session_state.context_window # 会話の要約も破棄し、再実行時に作り直す
     st.session_state.game_name = "" # ゲーム名をクリア
     st.session_state.url = "" # URLをクリア
+    st.session_state.session_id = None # 保存済みのセッションはURLのセッションIDから再開できるよう、ストアには残す
+    st.query_params.pop("session", None)
     st.rerun() # アプリを再実行し、初期状態に戻す
 
+# デバッグ情報 (直近の処理の所要時間とトークン数) の表示欄 (サイドバーに配置し、内容はスクリプトの最後に描画)
+show_debug_panel = st.sidebar.checkbox("デバッグ情報を表示", value=os.getenv("DEBUG_PANEL") == "1")
+debug_panel = st.sidebar.empty()
+
 # メインアプリケーションロジック
 
 # セッション開始フェーズ: ゲーム名が設定されていない場合
@@ -86,6 +176,26 @@ if not st.session_state.game_name:
             with st.spinner("アシスタントとのセッションを準備中..."):
                 st.session_state.game_name = game_name_input # ゲーム名をセッション状態に保存
                 st.session_state.url = url_input # URLをセッション状態に保存 (空でも可)
+                # 参照URLがある場合は、サイトを巡回して検索インデックスに追加する
+                # (最近インデックスに追加したURLは巡回せず、古い場合もページの取得はキャッシュを経由して再検証だけで済ませる)
+                if st.session_state.url:
+                    index = get_retrieval_index(st.session_state.game_name)
+                    with start_trace("session_start", game_name=st.session_state.game_name, url=st.session_state.url) as trace:
+                        with span("index_site"):
+                            record("indexed_pages", index_site(index, st.session_state.url, page_cache=get_page_cache()))
+                    st.session_state.last_trace = trace.to_dict()
+                    # インデックスにはフラグメント (#...) を除いたURLで登録されるため、同じ形に正規化して確認する
+                    if not index.has_url(normalize_url(st.session_state.url)):
+                        st.warning("参照URLの内容を取得できませんでした。URLの情報はプロンプトにのみ含めます。")
+
+                # ゲーム名とURLを含む指示文は、ここで一度だけ構築されます
+                st.session_state.history = ConversationHistory(st.session_state.game_name, st.session_state.url)
+                st.session_state.context_window = ContextWindow(make_gemini_summarizer(gemini_model))
+                # セッションをストアに保存し、URLのセッションIDから再開できるようにする
+                st.session_state.session_id = get_session_store().create(
+                    {"game_name": st.session_state.game_name, "url": st.session_state.url}
+                )
+                st.query_params["session"] = st.session_state.session_id
 
                 # 初回のアシスタントメッセージを構築し、会話履歴に追加
                 initial_assistant_message = f"**{st.session_state.game_name}** の攻略アシスタントを開始します。\n\n"
@@ -96,7 +206,7 @@ if not st.session_state.game_name:
                 
                 initial_assistant_message += "何か質問はありますか？"
                 
-                st.session_state.messages.append({"role": "assistant", "content": initial_assistant_message})
+                append_message("assistant", initial_assistant_message)
                 st.rerun() # ページを再実行し、会話フェーズへ移行
 
 # 会話フェーズ: ゲーム名が設定されている場合
@@ -107,66 +217,86 @@ else:
     else:
         st.write("（Webサイトの参照なし、Gemini AIのWeb検索を利用）")
 
+    # メモリから追い出した古いメッセージは、必要なときだけセッションストアから読み込む
+    history = st.session_state.history
+    if history.messages_offset and st.session_state.session_id:
+        if st.button(f"以前のメッセージを表示（残り {history.messages_offset} 件）"):
+            start = max(history.messages_offset - get_max_in_memory_messages(), 0)
+            history.prepend_messages(get_session_store().load_messages(st.session_state.session_id, start, history.messages_offset))
+
     # 既存のメッセージ履歴を表示
-    for message in st.session_state.messages:
+    for message in st.session_state.history.messages:
         with st.chat_message(message["role"]):
             st.markdown(message["content"])
 
     # ユーザーからの新しい質問を受け付けるチャット入力欄
     if prompt := st.chat_input("質問を入力してください..."):
         # ユーザーの質問を履歴に追加し、表示
-        st.session_state.messages.append({"role": "user", "content": prompt})
+        append_message("user", prompt)
         with st.chat_message("user"):
             st.markdown(prompt)
 
-        with st.chat_message("assistant"):
-            with st.spinner("考え中..."):
-                # Gemini APIに渡すための会話履歴を構築
-                # Gemini APIは `{"role": "role_name", "parts": ["content_text"]}` の形式を期待します。
-                conversation_for_gemini = []
-                
-                # Streamlitのセッション履歴をGemini APIが期待する形式に変換
-                # 最初のユーザーのターンにのみ、ゲーム名とURL情報を付加した特別なプロンプトを生成します。
-                for i, msg in enumerate(st.session_state.messages):
-                    if i == 0 and msg["role"] == "assistant":
-                        # アシスタントの初期ウェルカムメッセージ（UI表示用）はGeminiには渡しません。
-                        continue 
-                    
-                    # ユーザーからの最初の具体的な質問（履歴の2番目のメッセージ、つまり最初の'user'ロール）
-                    if i == 1 and msg["role"] == "user": 
-                         if st.session_state.url:
-                             # URLがある場合はURL参照を優先する指示をプロンプトに含めます。
-                             formatted_content = f"""
-                            あなたはゲーム攻略アシスタントです。ユーザーの質問に対し、**提供されたURL（{st.session_state.url}）の情報を最優先に参照し、そのURLから回答が得られない場合や、より補足情報が必要な場合のみWeb検索（Grounding機能）を活用して**、最も適切で役立つ攻略情報を提供してください。
-                            回答は日本のゲームプレイヤー向けに、分かりやすく、整理された自然な日本語で提供してください。
-
-                            ---
-                            **ゲーム名:** {st.session_state.game_name}
-                            ---
-                            ユーザーからの質問: {msg["content"]}
-                            """
-                         else:
-                             # URLがない場合はWeb検索のみの指示をプロンプトに含めます。
-                             formatted_content = f"""
-                            あなたはゲーム攻略アシスタントです。ユーザーの質問に対し、**Web検索（Grounding機能）を活用して**、最も適切で役立つ攻略情報を提供してください。
-                            回答は日本のゲームプレイヤー向けに、分かりやすく、整理された自然な日本語で提供してください。
-
-                            ---
-                            **ゲーム名:** {st.session_state.game_name}
-                            ---
-                            ユーザーからの質問: {msg["content"]}
-                            """
-                         conversation_for_gemini.append({"role": msg["role"], "parts": [formatted_content]})
-                    else:
-                        # それ以外のメッセージは、コンテンツをそのままpartsリストに入れて追加します。
-                        conversation_for_gemini.append({"role": msg["role"], "parts": [msg["content"]]})
-
-                # Gemini AIに問い合わせを行う
-                gemini_response = ask_gemini(gemini_model, conversation_for_gemini)
-
-                if gemini_response:
-                    st.markdown(gemini_response) # Geminiの回答をUIに表示
-                    st.session_state.messages.append({"role": "assistant", "content": gemini_response}) # 回答を履歴に追加
-                else:
-                    st.error("Gemini AIからの回答取得に失敗しました。")
+        with st.chat_message("assistant"), start_trace("chat", game_name=st.session_state.game_name) as trace:
+            # 最初の質問や文脈に依存しない質問は、同じゲーム・URLでの過去の回答をキャッシュから返す
+            cache_key = (gemini_model.model_name, st.session_state.game_name, st.session_state.url, prompt)
+            is_first_turn = st.session_state.history.content_count == 1
+            cacheable = is_cacheable_question(prompt, is_first_turn=is_first_turn)
+            cached_response = get_response_cache().get(*cache_key) if cacheable else None
+            record("cache_hit", cached_response is not None)
+
+            # 参照サイトから質問に関連する部分を検索する (回答経路の判定と、今回の質問への付加の両方に使う)
+            reference_chunks = []
+            if not cached_response:
+                with span("retrieval"):
+                    reference_chunks = search_reference(prompt)
+
+            # キャッシュや参照サイトの該当箇所で答えられる質問はモデルを呼ばず、それ以外は質問の難しさでモデルを選ぶ
+            route = route_question(prompt, is_first_turn, cached_answer=cached_response, chunks=reference_chunks)
+            gemini_response = route["answer"]
+            if gemini_response:
+                st.markdown(gemini_response)
+            else:
+                # 軽量なモデルの初期化に失敗している場合は、通常のモデルで回答する
+                model = fast_model if route["model_name"] and fast_model is not None else gemini_model
+                record("model", model.model_name)
+                # トークン予算を超えた場合は、古いやり取りを要約してから送信する
+                with st.spinner("質問の準備中..."):
+                    summarized_upto = st.session_state.context_window.summarized_upto
+                    with span("history_build"):
+                        conversation_for_gemini = st.session_state.context_window.build(st.session_state.history)
+                    # 参照サイトから検索した部分を、今回の質問に付加する
+                    conversation_for_gemini = with_reference(conversation_for_gemini, format_reference_chunks(reference_chunks))
+
+                # Gemini AIに問い合わせを行い、回答をストリーミングで逐次表示する
+                response_placeholder = st.empty()
+                gemini_response, completed = render_stream(
+                    response_placeholder, ask_gemini_stream(model, conversation_for_gemini)
+                )
+                record("stream_completed", completed)
+                # 途中で中断された回答はキャッシュしない (履歴には中断された旨の注記付きで残す)
+                # キャッシュは通常のモデル名で引くため、軽量なモデルの回答は通常のモデルの回答として保存しない
+                if completed and cacheable and model is gemini_model:
+                    get_response_cache().put(*cache_key, gemini_response)
+                # 会話の要約が更新された場合は、再開時に使えるようストアに保存する
+                window = st.session_state.context_window
+                if st.session_state.session_id and window.summarized_upto != summarized_upto:
+                    get_session_store().update_state(
+                        st.session_state.session_id, summary=window.summary, summarized_upto=window.summarized_upto
+                    )
+
+            if gemini_response:
+                # ストリーム終了後、全文を履歴に追加
+                append_message("assistant", gemini_response)
+            else:
+                st.error("Gemini AIからの回答取得に失敗しました。")
+        # 要約済みのやり取りと古いメッセージはメモリから追い出す (必要になればセッションストアから読み直す)
+        st.session_state.history.page_out(get_max_in_memory_messages(), st.session_state.context_window.summarized_upto)
+        st.session_state.last_trace = trace.to_dict()
 
+# 直近の処理の計測結果をサイドバーに表示
+if show_debug_panel and st.session_state.last_trace:
+    with debug_panel.container():
+        st.caption("直近の処理の計測結果")
+        st.json(st.session_state.last_trace)
+        st.caption("回答キャッシュ")
+        st.json(get_response_cache().stats())
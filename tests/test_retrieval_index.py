@@ -0,0 +1,33 @@
+import retrieval_index
+from crawler import normalize_url
+from retrieval_index import RetrievalIndex, index_site
+
+
+def fake_crawl_site(seed_url, **kwargs):
+    yield {"url": seed_url, "depth": 0, "parsed": {"title": "攻略", "body_text": "ボスの弱点は頭です。", "links": []}}
+
+
+def test_index_site_registers_fragment_url_without_fragment(tmp_path, monkeypatch):
+    monkeypatch.setattr(retrieval_index, "crawl_site", fake_crawl_site)
+    index = RetrievalIndex("game", index_dir=str(tmp_path))
+
+    assert index_site(index, "http://example.com/guide#boss", refresh_seconds=60) == 1
+    assert index.has_url(normalize_url("http://example.com/guide#boss"))
+    # 同じページの別のフラグメントは、インデックス済みとして巡回しない
+    assert index_site(index, "http://example.com/guide#items", refresh_seconds=60) == 0
+
+
+def test_search_embeds_query_without_holding_the_index_lock(tmp_path):
+    lock_held_during_embed = []
+
+    def embed_fn(texts):
+        lock_held_during_embed.append(index._lock._is_owned())
+        return [[1.0, float(i)] for i, _ in enumerate(texts)]
+
+    index = RetrievalIndex("game", index_dir=str(tmp_path), embed_fn=embed_fn)
+    index.add_page("http://example.com/a", {"title": "A", "body_text": "ボスの弱点は頭です。"})
+    results = index.search("ボスの弱点", top_k=1)
+
+    assert results[0]["url"] == "http://example.com/a"
+    # 最後の呼び出しが質問の埋め込み (ネットワーク越しの呼び出し中はロックを持たない)
+    assert lock_held_during_embed[-1] is False
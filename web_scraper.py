@@ -1,89 +1,370 @@
+import codecs
+import re
+import threading
+import time
+from collections.abc import Iterator
+from html.parser import HTMLParser
 import requests
-from bs4 import BeautifulSoup
-from urllib.parse import urljoin, urlparse
+from requests.adapters import HTTPAdapter
+from urllib.parse import urljoin
+from config import env_number
+from instrumentation import current_trace, traced
 
-def fetch_html_content(url: str) -> str | None:
+# 配下をまるごと解析対象外にするタグ (本文にもリンクにも含めない)
+SKIP_TAGS = {'head', 'script', 'style', 'noscript', 'template', 'iframe', 'svg'}
+# 配下のテキストを本文に含めないタグ (ヘッダー、フッター、ナビゲーション、サイドバーなど)
+# リンクはサイト内の巡回に使えるため、これらの中からも抽出します。
+BOILERPLATE_TAGS = {'header', 'footer', 'nav', 'aside'}
+# 配下のテキストを本文に含めないクラス名 (広告など)
+BOILERPLATE_CLASSES = {'header', 'footer', 'nav', 'sidebar', 'ad', 'advertisement', 'widget', 'menu'}
+
+# ストリーミングでの取得時に読み込むHTMLの最大バイト数 (環境変数 HTML_MAX_BYTES で変更可能)
+# 巨大なページでもメモリ使用量が一定に収まるよう、これを超えた部分は切り捨てます。
+DEFAULT_HTML_MAX_BYTES = 5 * 1024 * 1024
+# ストリーミングで1回に読み込むバイト数と、文字コードの判定に使う先頭部分のバイト数
+STREAM_CHUNK_BYTES = 64 * 1024
+ENCODING_SNIFF_BYTES = 64 * 1024
+# 1つのテキストブロックの最大文字数 (段落の区切りがない巨大な要素も、この長さで区切って出力する)
+MAX_TEXT_BLOCK_CHARS = 2000
+
+# テキストブロックの区切りとするタグ (段落、見出し、リスト、表のセルなど)
+BLOCK_TAGS = {
+    'p', 'div', 'section', 'article', 'main', 'li', 'ul', 'ol', 'dl', 'dt', 'dd', 'table', 'tr', 'td', 'th',
+    'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'br', 'hr', 'blockquote', 'pre', 'header', 'footer', 'nav', 'aside',
+}
+# 終了タグを持たない要素 (開いているタグのスタックに積まない)
+VOID_TAGS = {'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'source', 'track', 'wbr'}
+# 終了タグが省略されやすい要素 (同じタグが続いた場合は、前のタグが閉じたものとみなす)
+AUTO_CLOSE_TAGS = {'p', 'li', 'dt', 'dd', 'tr', 'td', 'th', 'option'}
+
+CONTENT_TYPE_CHARSET_RE = re.compile(r'charset=["\']?([\w.:-]+)', re.IGNORECASE)
+META_CHARSET_RE = re.compile(rb'<meta[^>]+charset=["\']?([\w.:-]+)', re.IGNORECASE)
+
+# User-Agentを設定することで、一部のサイトでのブロックを避けることができます。
+DEFAULT_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+}
+
+# 同一ホストへの接続を使い回すための、プロセス全体で共有するセッション
+# (ホストごとに保持するKeep-Alive接続の数)
+SESSION_POOL_SIZE = 16
+_session = None
+_session_lock = threading.Lock()
+
+def get_session() -> requests.Session:
     """
-    指定されたURLからHTMLコンテンツを取得します。
-    ネットワークエラーやHTTPエラーを処理します。
+    Keep-Alive接続をプールする requests.Session を返します。
+    初回呼び出し時に作成し、以降はプロセス内で同じセッションを共有します。
     """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=SESSION_POOL_SIZE, pool_maxsize=SESSION_POOL_SIZE)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                session.headers.update(DEFAULT_HEADERS)
+                _session = session
+    return _session
+
+def get_html_max_bytes() -> int:
+    return env_number("HTML_MAX_BYTES", DEFAULT_HTML_MAX_BYTES)
+
+def _valid_encoding(name: str | None) -> str | None:
+    if not name:
+        return None
     try:
-        # User-Agentを設定することで、一部のサイトでのブロックを避けることができます。
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-        }
-        response = requests.get(url, headers=headers, timeout=10) # 10秒のタイムアウトを設定
-        response.raise_for_status() # HTTPエラー（4xx, 5xx）があれば例外を発生させる
-        response.encoding = response.apparent_encoding # 取得したコンテンツのエンコーディングを自動検出
-        return response.text
-    except requests.exceptions.RequestException as e:
-        print(f"URL '{url}' の取得中にエラーが発生しました: {e}")
+        return codecs.lookup(name).name
+    except LookupError:
         return None
 
-def parse_html_content(html_content: str) -> dict:
+def detect_encoding(content_type: str | None, prefix: bytes) -> str:
     """
-    HTMLコンテンツを解析し、タイトル、主要な本文、およびリンクを抽出します。
+    HTMLの文字コードを、Content-Type ヘッダー、<meta> の charset、先頭部分の推定の順に決めます。
+    推定には本文全体ではなく先頭の prefix だけを使います。
     """
-    soup = BeautifulSoup(html_content, 'html.parser')
-    
-    # タイトルを抽出
-    # <title>タグが見つからない場合は「タイトルなし」とする
-    title = soup.find('title').get_text(strip=True) if soup.find('title') else 'タイトルなし'
-    
-    # 主要な本文を抽出 (より広範囲のタグからテキストを結合)
-    # 一般的なコンテンツタグを対象としますが、スクリプトやスタイル、ナビゲーションなどは除外します。
-    body_elements = soup.find_all(['p', 'div', 'article', 'main', 'span', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6'])
-    body_text_parts = []
-    for element in body_elements:
-        # スクリプト、スタイル、ヘッダー、フッター、ナビゲーション、サイドバー、コメントなどは除外
-        if element.name in ['script', 'style', 'header', 'footer', 'nav', 'aside', 'comment']:
-            continue
-        # 特定のクラス名を持つ要素を除外する例 (広告など)
-        if element.get('class') and any(cls in element['class'] for cls in ['header', 'footer', 'nav', 'sidebar', 'ad', 'advertisement', 'widget', 'menu']):
-            continue
-        
-        text = element.get_text(separator=' ', strip=True)
+    match = CONTENT_TYPE_CHARSET_RE.search(content_type or '')
+    encoding = _valid_encoding(match.group(1)) if match else None
+    if encoding:
+        return encoding
+    match = META_CHARSET_RE.search(prefix)
+    encoding = _valid_encoding(match.group(1).decode('ascii', 'ignore')) if match else None
+    if encoding:
+        return encoding
+    from charset_normalizer import from_bytes  # requests の依存関係としてインストールされている
+    best = from_bytes(prefix).best()
+    return _valid_encoding(best.encoding if best else None) or 'utf-8'
+
+class _TimedIterator:
+    """
+    イテレーターの次の要素を取り出すのにかかった時間の合計（seconds）を計測します。
+    """
+
+    def __init__(self, iterator):
+        self._iterator = iterator
+        self.seconds = 0.0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            return next(self._iterator)
+        finally:
+            self.seconds += time.perf_counter() - start
+
+def iter_response_text(response: requests.Response, max_bytes: int) -> Iterator[str]:
+    """
+    stream=True で取得したレスポンスの本文を、少しずつ文字列にデコードして yield します。
+    max_bytes を超えた部分は読み込みません。
+    """
+    chunks = response.iter_content(chunk_size=STREAM_CHUNK_BYTES)
+    received = 0
+    prefix = b''
+    # 文字コードの判定に使う先頭部分を読み込む
+    for chunk in chunks:
+        chunk = chunk[:max_bytes - received]
+        received += len(chunk)
+        prefix += chunk
+        if len(prefix) >= ENCODING_SNIFF_BYTES or received >= max_bytes:
+            break
+
+    decoder = codecs.getincrementaldecoder(detect_encoding(response.headers.get('Content-Type'), prefix))(errors='replace')
+    yield decoder.decode(prefix)
+    if received < max_bytes:
+        for chunk in chunks:
+            chunk = chunk[:max_bytes - received]
+            received += len(chunk)
+            yield decoder.decode(chunk)
+            if received >= max_bytes:
+                break
+    if received >= max_bytes:
+        print(f"URL '{response.url}' の本文が上限 ({max_bytes} バイト) に達したため、以降を切り捨てました。")
+    yield decoder.decode(b'', final=True)
+
+class HTMLEventExtractor(HTMLParser):
+    """
+    HTMLを少しずつ受け取りながら解析し、('title', str) / ('text', str) / ('link', dict) のイベントを返します。
+    DOMツリーを作らず、開いているタグのスタックと書きかけのテキストブロックだけを保持します。
+    定型部分のテキストは本文から除き、リンクはそれらの中からも抽出します。
+    ページの取得（fetch_and_parse_stream）と取得済みのHTMLの解析（parse_html_content）は、どちらもこのクラスで解析します。
+    """
+
+    def __init__(self, base_url: str = ''):
+        super().__init__(convert_charrefs=True)
+        self.base_url = base_url
+        self._stack: list[tuple[str, bool, bool]] = [] # (タグ名, 解析対象外か, 本文に含めるか)
+        self._events: list[tuple[str, object]] = []
+        self._data: list[str] = [] # 次のタグまでのテキスト (入力の区切りで分割されたテキストノードをつなげる)
+        self._data_chars = 0
+        self._block: list[str] = []
+        self._block_chars = 0
+        self._title: list[str] | None = None
+        self._title_done = False
+        self._link: dict | None = None
+        self._link_text: list[str] = []
+
+    def _state(self) -> tuple[bool, bool]:
+        if not self._stack:
+            return False, True
+        return self._stack[-1][1], self._stack[-1][2]
+
+    def _flush_block(self) -> None:
+        if self._block:
+            self._events.append(('text', ' '.join(self._block)))
+            self._block = []
+            self._block_chars = 0
+
+    def _flush_link(self) -> None:
+        if self._link is not None:
+            self._link['text'] = ''.join(text.strip() for text in self._link_text)
+            self._events.append(('link', self._link))
+            self._link = None
+            self._link_text = []
+
+    def handle_starttag(self, tag, attrs):
+        self._flush_data()
+        if tag == 'title' and not self._title_done:
+            self._title = []
+        if tag in BLOCK_TAGS:
+            self._flush_block()
+        if tag in VOID_TAGS:
+            return
+        if tag in AUTO_CLOSE_TAGS and self._stack and self._stack[-1][0] == tag:
+            self.handle_endtag(tag)
+
+        skipped, in_body = self._state()
+        skipped = skipped or tag in SKIP_TAGS
+        attributes = dict(attrs)
+        classes = (attributes.get('class') or '').split()
+        if in_body and (tag in BOILERPLATE_TAGS or not BOILERPLATE_CLASSES.isdisjoint(classes)):
+            in_body = False
+        self._stack.append((tag, skipped, in_body))
+        if tag == 'a' and not skipped and attributes.get('href'):
+            self._flush_link()
+            # 相対URLを絶対URLに変換 (base_url が空の場合は相対URLのまま)
+            self._link = {'text': '', 'url': urljoin(self.base_url, attributes['href'])}
+
+    def handle_endtag(self, tag):
+        self._flush_data()
+        if tag == 'title' and self._title is not None:
+            self._events.append(('title', ' '.join(''.join(self._title).split())))
+            self._title = None
+            self._title_done = True
+        if tag in BLOCK_TAGS:
+            self._flush_block()
+        if tag == 'a':
+            self._flush_link()
+        # 対応する開始タグまで閉じる (対応する開始タグがない終了タグは無視する)
+        for i in range(len(self._stack) - 1, -1, -1):
+            if self._stack[i][0] == tag:
+                del self._stack[i:]
+                break
+
+    def handle_data(self, data):
+        self._data.append(data)
+        self._data_chars += len(data)
+        if self._data_chars >= MAX_TEXT_BLOCK_CHARS:
+            # タグを含まない巨大なテキストも、一定の長さごとに処理してメモリに溜め込まない
+            self._flush_data()
+
+    def _flush_data(self) -> None:
+        if not self._data:
+            return
+        data = ''.join(self._data)
+        self._data = []
+        self._data_chars = 0
+        if self._title is not None:
+            self._title.append(data)
+            return
+        skipped, in_body = self._state()
+        if skipped:
+            return
+        if self._link is not None:
+            self._link_text.append(data)
+        if not in_body:
+            return
+        # 改行を含む連続した空白を単一のスペースにまとめる
+        text = ' '.join(data.split())
         if text:
-            body_text_parts.append(text)
-            
-    # 複数行の改行を単一のスペースに置換し、余分な空白を削除
-    body_text = ' '.join(body_text_parts).replace('\n', ' ').replace('\r', '').strip()
-    
-    # リンクを抽出 (絶対URLに変換)
+            self._block.append(text)
+            self._block_chars += len(text)
+            if self._block_chars >= MAX_TEXT_BLOCK_CHARS:
+                self._flush_block()
+
+    def feed_events(self, data: str) -> list[tuple[str, object]]:
+        """
+        HTMLの続きを解析し、新たに確定したイベントを返します。
+        """
+        self.feed(data)
+        events, self._events = self._events, []
+        return events
+
+    def close_events(self) -> list[tuple[str, object]]:
+        """
+        解析を終了し、残りのイベントを返します。
+        """
+        self.close()
+        self._flush_data()
+        self._flush_link()
+        self._flush_block()
+        events, self._events = self._events, []
+        return events
+
+def iter_html_events(html_chunks, base_url: str = '') -> Iterator[tuple[str, object]]:
+    """
+    少しずつ届くHTMLの文字列を解析し、('title', str) / ('text', str) / ('link', dict) のイベントを順に yield します。
+    """
+    extractor = HTMLEventExtractor(base_url)
+    for chunk in html_chunks:
+        yield from extractor.feed_events(chunk)
+    yield from extractor.close_events()
+
+def collect_html_events(events) -> dict:
+    """
+    イベントを parse_html_content と同じ形式の解析結果にまとめます。
+    """
+    title = None
+    body_text_parts = []
     links = []
-    # href属性を持つ<a>タグをすべて検索
-    for a_tag in soup.find_all('a', href=True):
-        href = a_tag['href']
-        # 相対URLを絶対URLに変換 (ベースURLが必要)
-        # この関数が単独で使われる場合、urljoinの第1引数にベースURLを渡す必要があります。
-        # ここでは、あくまでスクレイピングされたHTMLのリンクを抽出する目的で、
-        # 外部から渡されるURLをベースURLとして仮定しています。
-        # 実際の使用例では、この関数を呼び出す側でベースURLを適切に管理する必要があります。
-        full_url = urljoin(url, href) # url はこの関数内で定義されていないため、実際にはエラーになります。
-                                      # このコードはあくまで単独テスト用であり、
-                                      # `game_assistant.py` や `streamlit_app.py` から呼ばれることを想定していません。
-        links.append({'text': a_tag.get_text(strip=True), 'url': full_url})
-            
+    for kind, value in events:
+        if kind == 'text':
+            body_text_parts.append(value)
+        elif kind == 'link':
+            links.append(value)
+        elif kind == 'title' and title is None:
+            title = value
     return {
-        'title': title,
-        'body_text': body_text,
+        'title': title or 'タイトルなし',
+        'body_text': ' '.join(body_text_parts),
         'links': links
     }
 
+def fetch_and_parse_stream(url: str, etag: str | None = None, last_modified: str | None = None, max_bytes: int | None = None) -> dict | None:
+    """
+    HTMLをストリーミングで取得しながら解析します。本文全体の文字列やDOMツリーを保持しないため、
+    ページが大きくてもメモリ使用量は max_bytes（デフォルトは環境変数 HTML_MAX_BYTES）程度に収まります。
+    etag / last_modified を渡すと条件付きリクエストになり、ページが更新されていない場合（304）は 'parsed' が None になります。
+    戻り値: {'status': int, 'parsed': dict | None, 'etag': str | None, 'last_modified': str | None}
+    エラー時は None を返します。
+    取得と解析は交互に進むため、本文の読み込みにかかった時間を fetch、解析にかかった時間を parse の span として別々に記録します。
+    """
+    trace = current_trace()
+    start = time.perf_counter()
+    parse_seconds = 0.0
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+    try:
+        with get_session().get(url, headers=headers, timeout=10, stream=True) as response:
+            if response.status_code == 304:
+                return {'status': 304, 'parsed': None, 'etag': etag, 'last_modified': last_modified}
+            response.raise_for_status()
+            html_chunks = _TimedIterator(iter_response_text(response, max_bytes or get_html_max_bytes()))
+            parse_start = time.perf_counter()
+            parsed = collect_html_events(iter_html_events(html_chunks, url))
+            # 解析の時間から、その間に本文を読み込んでいた時間を除く
+            parse_seconds = time.perf_counter() - parse_start - html_chunks.seconds
+            return {
+                'status': response.status_code,
+                'parsed': parsed,
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+            }
+    except requests.exceptions.RequestException as e:
+        print(f"URL '{url}' の取得中にエラーが発生しました: {e}")
+        return None
+    finally:
+        if trace is not None:
+            end = time.perf_counter()
+            trace.add_span("fetch", start, end - parse_seconds)
+            if parse_seconds:
+                trace.add_span("parse", end - parse_seconds, end)
+
+@traced("parse")
+def parse_html_content(html_content: str, base_url: str = '') -> dict:
+    """
+    取得済みのHTMLコンテンツを解析し、タイトル、主要な本文、およびリンクを抽出します。
+    base_url には取得元のURLを渡します。リンクの相対URLはこのURLを基準に絶対URLへ変換されます。
+    解析には fetch_and_parse_stream と同じ HTMLEventExtractor を使うため、結果はストリーミングで取得した場合と同じです。
+    """
+    return collect_html_events(iter_html_events([html_content], base_url))
+
 if __name__ == '__main__':
     # このスクリプトを直接実行した場合のテストコードです。
     # 実際のゲーム攻略サイトのURLに置き換えて試してみてください。
     test_url = "https://mynintendonews.com/2025/05/07/japan-latest-famitsu-review-scores-101/" # 例: ファミ通のレビュー記事
 
-    print(f"--- URLからコンテンツを取得中: {test_url} ---")
-    html = fetch_html_content(test_url)
+    print(f"--- URLからコンテンツを取得・解析中: {test_url} ---")
+    # 取得しながら解析し、リンクは取得元のURLを基準に絶対URLへ変換する
+    result = fetch_and_parse_stream(test_url)
 
-    if html:
-        print("\n--- コンテンツを解析中 ---")
-        # parse_html_content にはベースURLが必要ないため、urljoinの引数を修正する必要はありません。
-        # ただし、リンクの絶対URL化は、このテストブロックでは正しく動作しません。
-        # 本来の用途（streamlit_app.pyから呼ばれる）では使用されないため、ここでは無視します。
-        parsed_data = parse_html_content(html) 
+    if result:
+        parsed_data = result['parsed']
         
         print(f"\nタイトル: {parsed_data['title']}")
         print(f"\n本文の長さ: {len(parsed_data['body_text'])} 文字")